@@ -0,0 +1,52 @@
+import os
+import numpy as np
+
+# Compact alternatives to the dense one-hot text format of the submissions,
+# which is almost only zeros. The phoneme indices refer to the vocabulary file
+# (one phoneme per line) written at the root of the submission: index i is the
+# position of the 1 in the one-hot encoding of the phoneme on line i.
+DENSE = 'dense' # zerospeech format: one space separated one-hot row per frame
+INDEX = 'index' # one phoneme index per line, one line per frame
+RLE = 'rle' # run-length encoded: 'index count' per run of identical frames
+OUTPUT_FORMATS = (DENSE, INDEX, RLE)
+FILE_SUFFIXES = {DENSE: '.txt', INDEX: '.idx', RLE: '.rle'}
+VOCABULARY_FILENAME = 'vocabulary.txt'
+
+def write_vocabulary(output_path: str, vocabulary: list[str]):
+    with open(os.path.join(output_path, VOCABULARY_FILENAME), 'w') as f:
+        f.write(''.join(f'{p}\n' for p in vocabulary))
+
+def read_vocabulary(compact_path: str) -> list[str]:
+    with open(os.path.join(compact_path, VOCABULARY_FILENAME), 'r') as f:
+        return [l.strip('\n') for l in f.readlines()]
+
+def format_indices(indices: list[int], output_format: str) -> str:
+    """Text of a compact file from the phoneme index of each frame."""
+    if output_format == INDEX:
+        return ''.join(f'{i}\n' for i in indices)
+    if output_format == RLE:
+        runs = []
+        for i in indices:
+            if runs and runs[-1][0] == i:
+                runs[-1][1] += 1
+            else:
+                runs.append([i, 1])
+        return ''.join(f'{i} {n}\n' for i, n in runs)
+    raise ValueError(f'Unsupported compact format {output_format}, choose from {(INDEX, RLE)}.')
+
+def parse_indices(text: str, output_format: str) -> np.ndarray:
+    """Phoneme index of each frame, from the text of a compact file."""
+    values = np.array(text.split(), dtype=np.int64)
+    if output_format == INDEX:
+        return values
+    if output_format == RLE:
+        values = values.reshape(-1, 2)
+        return np.repeat(values[:, 0], values[:, 1])
+    raise ValueError(f'Unsupported compact format {output_format}, choose from {(INDEX, RLE)}.')
+
+def compact_format(file_name: str) -> str | None:
+    """Format of a compact file from its suffix, None for other files."""
+    for output_format, suffix in FILE_SUFFIXES.items():
+        if output_format != DENSE and file_name.endswith(suffix):
+            return output_format
+    return None
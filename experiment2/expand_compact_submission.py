@@ -0,0 +1,110 @@
+import argparse, os, sys
+from multiprocessing import Pool
+from pathlib import Path
+from typing import NamedTuple
+import numpy as np
+import compact_encoding as compact
+
+class ExpandArgs(NamedTuple):
+    compact_path: str
+    output_path: str
+    npy: bool = False # .npy files instead of the zerospeech text format
+    jobs: int = 1
+
+class ExpandTask(NamedTuple):
+    compact_file: str
+    output_file: str
+
+def dense_rows(vocabulary: list[str]) -> list[str]:
+    """Text line of the one-hot encoding of each phoneme index, as written by
+    TranscriptionSubmissionGenerator.save_representations."""
+    n = len(vocabulary)
+    return [' '.join('1' if j == i else '0' for j in range(n)) for i in range(n)]
+
+def expand_tasks(args: ExpandArgs) -> list[ExpandTask]:
+    tasks = []
+    compact_phonetic = os.path.join(args.compact_path, 'phonetic')
+    for subset in sorted(os.listdir(compact_phonetic)):
+        subset_path = os.path.join(compact_phonetic, subset)
+        if not os.path.isdir(subset_path):
+            continue
+        output_dir = os.path.join(args.output_path, 'phonetic', subset)
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        for f in sorted(os.listdir(subset_path)):
+            if compact.compact_format(f) is None:
+                continue
+            name = os.path.splitext(f)[0] + ('.npy' if args.npy else '.txt')
+            tasks.append(ExpandTask(os.path.join(subset_path, f), os.path.join(output_dir, name)))
+    return tasks
+
+# Set in each worker by _init_worker, so that they are not sent with every task
+_rows: list[str] = []
+_one_hot: np.ndarray = np.empty(0)
+
+def _init_worker(vocabulary: list[str], npy: bool):
+    global _rows, _one_hot
+    if npy:
+        _one_hot = np.eye(len(vocabulary), dtype=np.float32)
+    else:
+        _rows = dense_rows(vocabulary)
+
+def expand_file(task: ExpandTask):
+    with open(task.compact_file, 'r') as f:
+        indices = compact.parse_indices(f.read(), compact.compact_format(task.compact_file))
+    if len(_one_hot):
+        np.save(task.output_file, _one_hot[indices])
+        return
+    with open(task.output_file, 'w') as f:
+        f.write(''.join(f'{_rows[i]}\n' for i in indices))
+
+def expand_submission(args: ExpandArgs) -> int:
+    """Writes the dense version of every compact file of the submission.
+    Returns: the number of files written."""
+    vocabulary = compact.read_vocabulary(args.compact_path)
+    tasks = expand_tasks(args)
+    if args.jobs <= 1:
+        _init_worker(vocabulary, args.npy)
+        for task in tasks:
+            expand_file(task)
+    else:
+        with Pool(args.jobs, initializer=_init_worker, initargs=(vocabulary, args.npy)) as pool:
+            for _ in pool.imap_unordered(expand_file, tasks, chunksize=64):
+                pass
+    return len(tasks)
+
+def main(argv):
+    description = ("Expand a submission generated with --output_format index or rle "
+                   "into the dense one-hot zerospeech format.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "compact_path",
+        type=str,
+        help="Path of the compact submission (with vocabulary.txt)."
+    )
+    parser.add_argument(
+        "output_path",
+        type=str,
+        help="Path where the dense submission will be written."
+    )
+    parser.add_argument(
+        "--npy",
+        action="store_true",
+        help="Write float32 .npy arrays instead of the text format."
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes expanding files in parallel."
+    )
+    cmdlineargs = parser.parse_args(argv)
+    args = ExpandArgs(cmdlineargs.compact_path,
+                      cmdlineargs.output_path,
+                      cmdlineargs.npy,
+                      cmdlineargs.jobs)
+    n = expand_submission(args)
+    print(f"DONE. {n} files expanded.")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
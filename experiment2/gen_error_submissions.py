@@ -1,4 +1,4 @@
-import argparse, sys, os
+import argparse, sys, os, zlib
 import numpy as np
 import gen_transcription_submission as gen
 
@@ -7,10 +7,21 @@ ERROR_CHANCE = 0.5
 
 class ErrorSubmissionGenerator(gen.TranscriptionSubmissionGenerator):
     def __init__(self,
-                 boundary_shift: int):
+                 boundary_shift: int,
+                 per_file_seed: bool = False):
         self.boundary_shift = boundary_shift
+        self.per_file_seed = per_file_seed
 
     ## Subclass method implementations
+    def start_file(self, file_name: str):
+        # With --shard, each file is seeded on its own so that its errors do not
+        # depend on which other files the job generates. The boundary shift is
+        # part of the seed, so that the submissions still get independent errors.
+        # Without --shard, all the files draw from the single stream seeded in
+        # main, as for the submissions of the paper.
+        if self.per_file_seed:
+            np.random.seed([SEED, self.boundary_shift % 2**32, zlib.crc32(file_name.encode())])
+
     def with_errors(self,
                     phoneme_tokens: list[str]) -> list[str]:
         ban_i = -100
@@ -54,6 +65,8 @@ def add_parser_args(parser: argparse.ArgumentParser):
         type=str, 
         help="Path where the submission(s) will be written."
     )
+    gen.add_parser_shard_args(parser)
+    gen.add_parser_format_args(parser)
     
 def main(argv):
     np.random.seed(SEED)
@@ -65,22 +78,33 @@ def main(argv):
     cmdlineargs = parser.parse_args(argv)
     transcriptions_top_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'transcriptions'))
 
+    complete = True
     for i in (-10, -8, -6):
         if i == 0:
             continue
-        sg = ErrorSubmissionGenerator(i)
+        sg = ErrorSubmissionGenerator(i, per_file_seed=cmdlineargs.shard.count > 1)
         output_path = f'{cmdlineargs.output_path}-randomshift{i}'
         args = gen.GeneratorArgs(transcriptions_top_path,
                                  output_path,
                                  gen.TRANSCRIPTION_SUBMISSION_MAP,
                                  gen.TRANSCRIPTION_TEXTDIRNAME,
                                  gen.TRANSCRIPTION_FILENAME,
-                                 gen.FILE_LIST_ALIGNMENT_FILENAME)
+                                 gen.FILE_LIST_ALIGNMENT_FILENAME,
+                                 cmdlineargs.shard,
+                                 cmdlineargs.output_format)
+        if cmdlineargs.verify:
+            print(f'Verifying {output_path}')
+            complete = gen.report_verification(sg.verify_submission(args)) and complete
+            continue
         sg.generate_submission(args)
         print(f"""
               Generating 1-hot encoded transcription submission with some shifted boundaries. 
               Params:\n{args}\n, i={i}\n
               """)
+    if cmdlineargs.verify:
+        if not complete:
+            sys.exit(1)
+        return
     print("\nDONE. Submissions with boundary shifts generated.")
 
 if __name__ == "__main__":
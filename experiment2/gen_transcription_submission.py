@@ -2,6 +2,10 @@ import argparse, os, sys
 from pathlib import Path
 from typing import NamedTuple
 import one_hot_encoder as ohencoder
+import compact_encoding as compact
+# Files are assigned to shards by the same rule as in experiment3
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'experiment3', 'mapcode'))
+from sharding import NO_SHARDING, Shard, in_shard, parse_shard
 
 TRANSCRIPTION_SUBMISSION_MAP = {'valid-clean': 'dev-clean',
                                 'valid-other': 'dev-other',
@@ -18,6 +22,8 @@ class GeneratorArgs(NamedTuple):
     transcription_textdirname: str
     transcription_filename: str
     filelist_filename: str
+    shard: Shard = NO_SHARDING # only generate the files of this shard
+    output_format: str = compact.DENSE # one of compact.OUTPUT_FORMATS
 
 class TranscriptionPath(NamedTuple):
     transcription_path: str
@@ -32,6 +38,11 @@ class OutputAbsolutePaths(NamedTuple):
     phonetic: str
     subpaths: tuple[str]
 
+class VerificationResult(NamedTuple):
+    n_expected: int
+    missing: list[str]
+    unexpected: list[str]
+
 class TranscriptionSubmissionGenerator:
     
     def all_phoneme_types(self, args: GeneratorArgs) -> PhonemeTypesResponse:
@@ -54,37 +65,81 @@ class TranscriptionSubmissionGenerator:
     def generate_submission(self, args: GeneratorArgs):
         phoneme_types, transcription_paths = self.all_phoneme_types(args)
         encoder_dict = ohencoder.encoder_dict(phoneme_types)
+        vocabulary = ohencoder.vocabulary(phoneme_types)
         self.create_submission_dirstructure(self.submission_absolute_paths(args))
+        if args.output_format != compact.DENSE:
+            compact.write_vocabulary(args.output_path, vocabulary)
+        phoneme_indices = {p: i for i, p in enumerate(vocabulary)}
         for transcription_path in transcription_paths:
-            self.process_subset(args, transcription_path, encoder_dict)
+            self.process_subset(args, transcription_path, encoder_dict, phoneme_indices)
 
     def process_subset(self,
                        args: GeneratorArgs,
                        transcription_path: TranscriptionPath,
-                       encoder_dict: dict[str, ohencoder.OHEncoding]):
+                       encoder_dict: dict[str, ohencoder.OHEncoding],
+                       phoneme_indices: dict[str, int]):
         with open(transcription_path.transcription_path, 'r') as f:
             # Each line corresponds to a file (the filenames can be found
             # in file_list_aligned.txt)
             transcription_lines = f.readlines()
-        alignment_file_path = os.path.join(args.transcriptions_top_path,
-                                           transcription_path.subset,
-                                           args.filelist_filename)
-        with open(alignment_file_path, 'r') as f:
-            filelist = [l.strip('\n') for l in f.readlines()]
+        filelist = self.filelist(args, transcription_path)
         for i, l in enumerate(transcription_lines):
+            if not in_shard(filelist[i], args.shard):
+                continue
             # One line in the transcription will correspond to one output file
             phoneme_tokens = l.strip('\n').split(' ')
+            self.start_file(filelist[i])
             phoneme_tokens = self.with_errors(phoneme_tokens)
+            save_filename = '{}{}'.format(filelist[i], compact.FILE_SUFFIXES[args.output_format])
+            if args.output_format != compact.DENSE:
+                self.save_compact_representations(args,
+                                                  save_filename,
+                                                  transcription_path,
+                                                  [phoneme_indices[p] for p in phoneme_tokens])
+                continue
             ohencoded_tokens = [ohencoder.encode_phoneme(p,
                                                         encoder_dict
                                                         ) for p in phoneme_tokens]
             
-            save_filename = '{}.txt'.format(filelist[i])
             self.save_representations(args,
                                       save_filename,
                                       transcription_path,
                                       ohencoded_tokens)
 
+    def filelist(self,
+                 args: GeneratorArgs,
+                 transcription_path: TranscriptionPath) -> list[str]:
+        """Names of the files, in the order of the transcription lines."""
+        alignment_file_path = os.path.join(args.transcriptions_top_path,
+                                           transcription_path.subset,
+                                           args.filelist_filename)
+        with open(alignment_file_path, 'r') as f:
+            return [l.strip('\n') for l in f.readlines()]
+
+    def verify_submission(self, args: GeneratorArgs) -> VerificationResult:
+        """Checks that the submission has exactly one file per transcribed file,
+        whatever the shards that were run, and nothing else. args.shard is ignored."""
+        expected: set[str] = set()
+        for subset in args.transcription_submission_map.keys():
+            transcription_path = TranscriptionPath('', subset)
+            out_dir = os.path.join(args.output_path, 'phonetic',
+                                   args.transcription_submission_map[subset])
+            suffix = compact.FILE_SUFFIXES[args.output_format]
+            expected.update(os.path.join(out_dir, f'{f}{suffix}')
+                            for f in self.filelist(args, transcription_path))
+        found: set[str] = set()
+        for d in self.submission_absolute_paths(args).subpaths:
+            if os.path.isdir(d):
+                found.update(os.path.join(d, f) for f in os.listdir(d))
+        return VerificationResult(len(expected),
+                                  sorted(expected - found),
+                                  sorted(found - expected))
+
+    def start_file(self, file_name: str):
+        """ Called before with_errors for each file. Can be used in a subclass,
+        e.g. to make the errors of a file independent of the other files."""
+        pass
+
     def with_errors(self,
                     phoneme_tokens: list[str]) -> list[str]:
         """ Can be used in a subclass to deliberately add errors. 
@@ -103,6 +158,18 @@ class TranscriptionSubmissionGenerator:
                 out_s = ' '.join(str(e) for e in phoneme)
                 f.write(f'{out_s}\n')
 
+    def save_compact_representations(self,
+                                     args: GeneratorArgs,
+                                     save_filename: str,
+                                     transcription_path: TranscriptionPath,
+                                     phoneme_indices: list[int]):
+        """Same as save_representations, with the phoneme index of each frame
+        in args.output_format instead of its one-hot encoding."""
+        subset = args.transcription_submission_map[transcription_path.subset]
+        output_file = os.path.join(args.output_path, 'phonetic', subset, save_filename)
+        with open(output_file, 'w') as f:
+            f.write(compact.format_indices(phoneme_indices, args.output_format))
+
     def create_submission_dirstructure(self, paths: OutputAbsolutePaths):
         l = [paths.output, paths.phonetic]
         l.extend(paths.subpaths)
@@ -121,6 +188,45 @@ def add_parser_args(parser: argparse.ArgumentParser):
         type=str, 
         help="Path where the submission will be written."
     )
+    add_parser_shard_args(parser)
+    add_parser_format_args(parser)
+
+def add_parser_format_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--output_format",
+        choices=compact.OUTPUT_FORMATS,
+        default=compact.DENSE,
+        help=("dense: the zerospeech format, one one-hot row per frame. index: one phoneme"
+              " index per frame. rle: 'index count' per run of identical frames. The compact"
+              " formats also write the phoneme of each index in vocabulary.txt; use"
+              " expand_compact_submission.py to get the dense format back.")
+    )
+
+def add_parser_shard_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=NO_SHARDING,
+        help=("Only generate shard i of N, given as i/N (0 <= i < N). Files are assigned"
+              " to shards by a stable hash of their utterance id, as in experiment3"
+              " (see experiment3/mapcode/sharding.py), so that N independent jobs"
+              " together generate the whole submission.")
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help=("Do not generate anything. Check that the submission has exactly one file"
+              " for every transcribed file (e.g. after running all the shards).")
+    )
+
+def report_verification(result: VerificationResult) -> bool:
+    for p in result.missing:
+        print(f'Missing: {p}')
+    for p in result.unexpected:
+        print(f'Unexpected: {p}')
+    print(f'{result.n_expected - len(result.missing)}/{result.n_expected} expected files found,'
+          f' {len(result.unexpected)} unexpected.')
+    return not result.missing and not result.unexpected
 
 def main(argv):
     description = ("Generate a zerospeech phonetic submission from the " 
@@ -135,7 +241,13 @@ def main(argv):
                         TRANSCRIPTION_SUBMISSION_MAP,
                         TRANSCRIPTION_TEXTDIRNAME, 
                         TRANSCRIPTION_FILENAME,
-                        FILE_LIST_ALIGNMENT_FILENAME)
+                        FILE_LIST_ALIGNMENT_FILENAME,
+                        cmdlineargs.shard,
+                        cmdlineargs.output_format)
+    if cmdlineargs.verify:
+        if not report_verification(sg.verify_submission(args)):
+            sys.exit(1)
+        return
     print(f"Generating 1-hot encoded transcription submission with params:\n{args}")
     sg.generate_submission(args)
     print("\nDONE. Transcription submission generated.")
@@ -2,10 +2,16 @@ import numpy as np
 
 OHEncoding = tuple[int]
 
+def vocabulary(element_set: set) -> list[str]:
+    """Elements in the order of the position of their 1 in the encoding."""
+    # sorted, so that the encoding does not depend on the process (set order
+    # changes with string hashing), e.g. when a submission is generated in shards
+    return sorted(element_set)
+
 def encoder_dict(element_set: set) -> dict[str, OHEncoding]:
     l = len(element_set)
     d: dict[str, OHEncoding] = {}
-    for i, e in enumerate(list(element_set)):
+    for i, e in enumerate(vocabulary(element_set)):
         v = [int(x) for x in np.zeros(l)]
         v[i] = 1
         d.setdefault(e, tuple(v))
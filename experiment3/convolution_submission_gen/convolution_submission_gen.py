@@ -3,26 +3,61 @@ import os
 import shutil
 import sys
 from pathlib import Path
-from typing import Callable
 
 import numpy as np
 
+import convolution_submission_gen_paths  # before io_pipeline and sharding
 from convolution_submission_gen_cmdline import *
 from convolution_submission_gen_constants import *
 from convolution_submission_gen_errors import *
+from convolution_submission_gen_kernels import Kernel, correlate, kernel_type
 from convolution_submission_gen_model import *
+from io_pipeline import pipelined
+from sharding import in_shard
 
 # This script generates a convolution submission, i.e. new representations
 # from existing representations, with a convolutional filter applied.
 
-# TYPE ALIASES
-ConvolutionFunc = Callable[[int, np.ndarray, GeneratorArgs], np.ndarray]
+# The kernels of each convolution type are registered in
+# convolution_submission_gen_kernels.
 
 # SUBMISSION GENERATOR
 class ConvolutionSubmissionGenerator:
     def generate_submission(self, args: GeneratorArgs):
         print(f"Generating submission. Args: {args}")
         print("...")
+        for s in self._subset_paths(args):
+            self._save_subset(s, args)
+            print(f"Subset {s} DONE.\n...")
+        if args.copy_meta:
+            self._copy_meta(args)
+        print("Submission generated.")
+
+    def verify_submission(self, args: GeneratorArgs) -> VerificationResult:
+        """Checks that every file of the original submission has exactly one
+        output file, whatever the shards that were run, and that the output
+        subset dirs contain nothing else. args.shard is ignored.
+        """
+        expected: set[str] = set()
+        for s in self._subset_paths(args):
+            for f in self._find_all_subset_files(s, REPR_FILE_EXTENSION):
+                expected.add(self.file_out_path(f, args))
+        found: set[str] = set()
+        for d in {os.path.dirname(p) for p in expected}:
+            if os.path.isdir(d):
+                found.update(
+                    os.path.join(d, f)
+                    for f in os.listdir(d)
+                    if f.endswith(REPR_FILE_EXTENSION)
+                )
+        return VerificationResult(
+            len(expected),
+            sorted(expected - found),
+            sorted(found - expected),
+        )
+
+    def _subset_paths(self, args: GeneratorArgs) -> list[str]:
+        subset_paths: list[str] = []
         for s in tuple(
             os.path.join(args.original_submission_path, PHONETIC, sub)
             for sub in SUBSETS
@@ -38,115 +73,88 @@ class ConvolutionSubmissionGenerator:
                 )
                 if not os.path.isdir(s):
                     raise FileNotFoundError(SUBDIR_NOT_FOUND_ERROR)
-            self._save_subset_representations(self._subset_output(s, args))
-            print(f"Subset {s} DONE.\n...")
-        if args.copy_meta:
-            self._copy_meta(args)
-        print("Submission generated.")
+            subset_paths.append(s)
+        return subset_paths
 
     # Private methods
-    def _subset_output(
-        self, subset_path: str, args: GeneratorArgs
+    def _save_subset(self, subset_path: str, args: GeneratorArgs):
+        """Reads, convolves and saves the subset by batches of args.batch_size
+        files. With args.io_threads > 0, reading the next batches and writing
+        the previous ones overlap with the convolution.
+        """
+        fs = [
+            f
+            for f in self._find_all_subset_files(subset_path, REPR_FILE_EXTENSION)
+            if in_shard(os.path.splitext(f.file_name)[0], args.shard)
+        ]
+        batches = [
+            fs[i : i + args.batch_size]
+            for i in range(0, len(fs), args.batch_size)
+        ]
+        for _ in pipelined(
+            batches,
+            self._loaded_batch,
+            lambda batch: self._batch_output(batch, args),
+            self._save_subset_representations,
+            args.io_threads,
+        ):
+            pass
+
+    def _loaded_batch(self, fs: list[SubmissionFilePath]) -> LoadedBatch:
+        return LoadedBatch(fs, [self._loaded(f) for f in fs])
+
+    def _batch_output(
+        self, batch: LoadedBatch, args: GeneratorArgs
     ) -> SubsetOutput:
-        file_outputs: list[FileOutput] = []
-        for f in self._find_all_subset_files(subset_path, REPR_FILE_EXTENSION):
-            file_outputs.append(self._file_output(f, args))
-        return SubsetOutput(file_outputs)
+        kernels = kernel_type(args.convolution_type).kernels(args)
+        out_ms = self._convolved_batch(batch.representations, kernels)
+        return SubsetOutput(
+            [
+                FileOutput(self.file_out_path(f, args), out_m)
+                for f, out_m in zip(batch.files, out_ms)
+            ]
+        )
 
-    def _file_output(
-        self, f: SubmissionFilePath, args: GeneratorArgs
-    ) -> FileOutput:
+    def _loaded(self, f: SubmissionFilePath) -> np.ndarray:
         m: np.ndarray = np.loadtxt(f.absolute_path)
         assert len(m.shape) == INPUT_DIMS
-        f_out_path = self.file_out_path(f, args)
-        convolution_func = self._get_convolution_func(args.convolution_type)
-        out_m = self._convolved(m, args, convolution_func)
-        return FileOutput(f_out_path, out_m)
-
-    def _get_convolution_func(self, convolution_type: str) -> ConvolutionFunc:
-        match self._convolution_type(convolution_type):
-            case Convolution.RUNNING_MEAN:
-                return self._running_mean
-            case Convolution.LAPLACIAN:
-                return self._laplacian
-            case Convolution.BLUR_THEN_SHARPEN:
-                return self._blur_then_sharpen
-            case other:
-                raise ValueError("Unsupported convolution type.")
+        return m
 
-    def _convolved(
-        self, m: np.ndarray, args: GeneratorArgs, convolution_f: ConvolutionFunc
-    ):
-        """Runs a convolution (running mean or laplacean) of step 1 and a given
-        window size over all the frames.
-        Padding added at the beginning and end during the convolution operation.
-        m: 2D numpy array where m[i] is the vector representation of frame i.
-        Returns: a numpy array of the same dimensions as m (padding removed).
+    def _convolved_batch(
+        self, ms: list[np.ndarray], kernels: list[Kernel]
+    ) -> list[np.ndarray]:
+        """Runs the kernels, one after the other, with step 1 over all the
+        frames of several files at once. ms[j][i] is the vector representation
+        of frame i of file j. Each file is padded at the beginning and end
+        during each convolution, and the padded files are concatenated so that
+        each kernel runs in a single pass; since each file gets its own
+        padding, no window ever spans two files. Returns one array per file,
+        of the same dimensions as in ms (padding removed), in the order of ms.
         """
-        if convolution_f == self._blur_then_sharpen:
-            running_m = self._convolved(m, args, self._running_mean)
-            return self._convolved(running_m, args, self._laplacian)
-
-        padded_m = self._padded(m, self._padding_size(args, convolution_f))
-        conv_m = np.zeros(m.shape)
-        for i in range(conv_m.shape[0]):
-            # window centered on row i of the non-padded array
-            conv_m[i] = convolution_f(i, padded_m, args)
-        return conv_m
-
-    # Convolution functions
-    def _running_mean(
-        self, i: int, padded_m: np.ndarray, args: GeneratorArgs
-    ) -> np.ndarray:
-        return padded_m[i : i + args.window_s_running_mean].mean(0)
-
-    def _laplacian(
-        self, i: int, padded_m: np.ndarray, args: GeneratorArgs
-    ) -> np.ndarray:
-        lapl = LAPLACIAN_3_MAX_SHARPEN if args.max_sharpen else LAPLACIAN_3
-        # ONLY window size 3 supported for now
-        return np.array(lapl).dot(padded_m[i : i + 3])
+        for kernel in kernels:
+            padding_n = len(kernel.taps) // 2
+            padded_m, offsets = self._padded_concatenation(ms, padding_n)
+            conv_m = correlate(padded_m, kernel)
+            # The window centered on row r of file j starts at offsets[j] + r
+            ms = [conv_m[o : o + m.shape[0]] for o, m in zip(offsets, ms)]
+        return ms
 
-    def _blur_then_sharpen(
-        self, i: int, padded_m: np.ndarray, args: GeneratorArgs
-    ) -> np.ndarray:
-        raise ValueError(UNREACHABLE_ERROR)
-
-    def _padding_size(self, args: GeneratorArgs, convolution_f: ConvolutionFunc):
-        window_s = None
-        if convolution_f == self._running_mean:
-            self._check_window_odd(args.window_s_running_mean)
-            window_s = args.window_s_running_mean
-        elif convolution_f == self._laplacian:
-            window_s = 3  # The only supported value for now
-        elif convolution_f == self._blur_then_sharpen:
-            self._check_window_odd(args.window_s_running_mean)
-            # we run the mean/blurring first
-            window_s = args.window_s_running_mean
-        else:
-            raise NotImplementedError
-        return int(np.floor(window_s / 2))
-
-    def _padded(self, m: np.ndarray, padding_n: int) -> np.ndarray:
-        padded_m = m.copy()
-        for _ in range(padding_n):
-            padded_m = np.insert(padded_m, 0, np.zeros(m.shape[1]), axis=0)
-            padded_m = np.append(padded_m, [np.zeros(m.shape[1])], axis=0)
-        return padded_m
-
-    def _check_window_odd(self, window_s: int):
-        if window_s % 2 == 0:
-            raise NotImplementedError(WINDOW_SIZE_EVEN_ERROR)
-
-    def _convolution_type(self, convolution: str) -> Convolution:
-        if convolution == RUNNING_MEAN:
-            return Convolution.RUNNING_MEAN
-        elif convolution == LAPLACIAN:
-            return Convolution.LAPLACIAN
-        elif convolution == BLUR_THEN_SHARPEN:
-            return Convolution.BLUR_THEN_SHARPEN
-        else:
-            raise ValueError(CONVOLUTION_TYPE_ERROR)
+    def _padded_concatenation(
+        self, ms: list[np.ndarray], padding_n: int
+    ) -> tuple[np.ndarray, list[int]]:
+        """Pads each array with padding_n zero frames at the beginning and end
+        and concatenates them. Returns the concatenation and the offset of
+        each padded array in it.
+        """
+        blocks: list[np.ndarray] = []
+        offsets: list[int] = []
+        offset = 0
+        for m in ms:
+            padding = np.zeros((padding_n, m.shape[1]))
+            blocks.extend((padding, m, padding))
+            offsets.append(offset)
+            offset += m.shape[0] + 2 * padding_n
+        return np.concatenate(blocks), offsets
 
     # IO
     def _copy_meta(self, args: GeneratorArgs):
@@ -214,25 +222,7 @@ class ConvolutionSubmissionGenerator:
         )
 
     def window_s_name(self, args: GeneratorArgs) -> str:
-        window_s = ""
-        match self._convolution_type(args.convolution_type):
-            case Convolution.RUNNING_MEAN:
-                window_s = f"{AV_WS_PREFIX}{args.window_s_running_mean}"
-            case Convolution.LAPLACIAN:
-                # The ONLY supported window size for now
-                window_s = f"{LAPL_WS_PREFIX}{LAPLACIAN_WS}"
-                if args.max_sharpen:
-                    window_s += MAX_SHARPEN_SUFFIX
-            case Convolution.BLUR_THEN_SHARPEN:
-                window_s = (
-                    f"{AV_WS_PREFIX}{args.window_s_running_mean}"
-                    f"_{LAPL_WS_PREFIX}{LAPLACIAN_WS}"
-                )
-                if args.max_sharpen:
-                    window_s += MAX_SHARPEN_SUFFIX
-            case other:
-                raise ValueError(CONVOLUTION_TYPE_ERROR)
-        return window_s
+        return kernel_type(args.convolution_type).window_s_name(args)
 
 
 def main(argv: list[str]):
@@ -251,9 +241,29 @@ def main(argv: list[str]):
         cmdlineargs.window_s_running_mean,
         cmdlineargs.max_sharpen,
         cmdlineargs.copy_meta,
+        cmdlineargs.batch_size,
+        cmdlineargs.io_threads,
+        cmdlineargs.shard,
+        cmdlineargs.window_s_laplacian,
+        cmdlineargs.sigma,
+        cmdlineargs.sigma_ratio,
+        tuple(cmdlineargs.kernel_taps),
     )
     sg = ConvolutionSubmissionGenerator()
-    sg.generate_submission(args)
+    if not cmdlineargs.verify:
+        sg.generate_submission(args)
+        return
+    result = sg.verify_submission(args)
+    for p in result.missing:
+        print(f"Missing: {p}")
+    for p in result.unexpected:
+        print(f"Unexpected: {p}")
+    print(
+        f"{result.n_expected - len(result.missing)}/{result.n_expected}"
+        f" expected files found, {len(result.unexpected)} unexpected."
+    )
+    if result.missing or result.unexpected:
+        raise SystemExit(OUTPUT_INCOMPLETE_ERROR)
 
 
 if __name__ == "__main__":
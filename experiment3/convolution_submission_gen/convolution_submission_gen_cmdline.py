@@ -1,6 +1,8 @@
 import argparse
 
+import convolution_submission_gen_paths  # before sharding
 from convolution_submission_gen_constants import *
+from sharding import parse_shard
 
 
 # CMDLINE INTERFACE DEFINITION
@@ -30,10 +32,13 @@ def add_parser_single_job_args(parser: argparse.ArgumentParser):
         "--convolution_type",
         type=str,
         default=RUNNING_MEAN,
-        choices=[RUNNING_MEAN, LAPLACIAN, BLUR_THEN_SHARPEN],
+        choices=CONVOLUTION_TYPES,
         help=(
-            "Type of the convolution. running_mean blurs,"
-            " laplacian sharpens edges."
+            "Type of the convolution. running_mean and gaussian blur,"
+            " laplacian sharpens edges, blur_then_sharpen runs running_mean"
+            " then laplacian, difference_of_gaussians is a band-pass filter"
+            " and custom applies --kernel_taps. Kernels of"
+            f" {FFT_MIN_TAPS} taps or more are applied through the FFT."
         ),
     )
 
@@ -42,8 +47,50 @@ def add_parser_single_job_args(parser: argparse.ArgumentParser):
         type=int,
         default=3,
         help=(
-            "Window size for the running mean convolution."
-            " (Laplacian only supports 3 and is assumed by default.)"
+            "Window size for the running mean convolution, also used by the"
+            " gaussian and difference_of_gaussians kernels."
+        ),
+    )
+
+    parser.add_argument(
+        "--window_s_laplacian",
+        type=int,
+        default=LAPLACIAN_WS,
+        help=(
+            "Window size for the laplacian: -1 on every neighbour, the center"
+            " weighs 2 (4 with --max_sharpen) per neighbour."
+        ),
+    )
+
+    parser.add_argument(
+        "--sigma",
+        type=float,
+        default=0.0,
+        help=(
+            "Standard deviation, in frames, of the gaussian kernels"
+            f" (0: window size / {GAUSSIAN_WINDOW_SIGMAS})."
+        ),
+    )
+
+    parser.add_argument(
+        "--sigma_ratio",
+        type=float,
+        default=GAUSSIAN_SIGMA_RATIO,
+        help=(
+            "difference_of_gaussians: ratio of the sigma of the subtracted"
+            " gaussian to --sigma."
+        ),
+    )
+
+    parser.add_argument(
+        "--kernel_taps",
+        type=float,
+        nargs="+",
+        default=[],
+        help=(
+            "custom: weights of the kernel, an odd number of them. Tap k"
+            " weighs frame t - len // 2 + k in output frame t. The output dir"
+            " is named after a digest of the taps."
         ),
     )
 
@@ -60,3 +107,47 @@ def add_parser_single_job_args(parser: argparse.ArgumentParser):
         default=True,
         action=argparse.BooleanOptionalAction,
     )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help=(
+            "Number of files convolved together in a single pass."
+            " Does not change the output, only speed and memory use."
+        ),
+    )
+
+    parser.add_argument(
+        "--io_threads",
+        type=int,
+        default=0,
+        help=(
+            "Number of reader threads (and of writer threads) prefetching"
+            " batches and writing results while the convolution runs."
+            " 0 runs everything sequentially."
+        ),
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default="0/1",
+        help=(
+            "Only process shard i of N, given as i/N (0 <= i < N). Files are"
+            " assigned to shards by a stable hash of their utterance id, the"
+            " same as in map_feature_extractor.py (see mapcode/sharding.py),"
+            " so that N independent jobs together generate the whole submission."
+        ),
+    )
+
+    parser.add_argument(
+        "--verify",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Do not generate anything. Check that the output has exactly one"
+            " file for every file of the original submission (e.g. after"
+            " running all the shards), and nothing else."
+        ),
+    )
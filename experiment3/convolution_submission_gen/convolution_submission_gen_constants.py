@@ -4,9 +4,15 @@ PHONETIC = "phonetic"
 SUBMISSION_D = "submission"
 REPR_FILE_EXTENSION = ".txt"  # only format supported at this point
 INPUT_DIMS = 2
-LAPLACIAN_3 = (-1, 4, -1)
-LAPLACIAN_3_MAX_SHARPEN = (-1, 8, -1)
-LAPLACIAN_WS = 3
+LAPLACIAN_WS = 3  # default window size of the laplacian
+# center weight of the laplacian per neighbour, i.e. (-1, 4, -1) and (-1, 8, -1)
+LAPLACIAN_CENTER = 2
+LAPLACIAN_MAX_SHARPEN_CENTER = 4
+GAUSSIAN_WINDOW_SIGMAS = 6  # default sigma: the window spans +-3 sigmas
+GAUSSIAN_SIGMA_RATIO = 1.6  # of the difference of gaussians
+# Kernels with at least this many taps are applied through the FFT,
+# shorter ones directly (faster below ~25-30 taps)
+FFT_MIN_TAPS = 31
 
 META_F_NAME = "meta.yaml"
 
@@ -14,8 +20,25 @@ META_F_NAME = "meta.yaml"
 RUNNING_MEAN = "running_mean"
 LAPLACIAN = "laplacian"
 BLUR_THEN_SHARPEN = "blur_then_sharpen"
+GAUSSIAN = "gaussian"
+DIFFERENCE_OF_GAUSSIANS = "difference_of_gaussians"
+CUSTOM = "custom"
+CONVOLUTION_TYPES = [
+    RUNNING_MEAN,
+    LAPLACIAN,
+    BLUR_THEN_SHARPEN,
+    GAUSSIAN,
+    DIFFERENCE_OF_GAUSSIANS,
+    CUSTOM,
+]
 
 # WINDOW_SIZE_DIRNAMES
 AV_WS_PREFIX = "av_ws_"
 LAPL_WS_PREFIX = "lapl_ws_"
 MAX_SHARPEN_SUFFIX = "_max_sharpen"
+GAUSS_WS_PREFIX = "gauss_ws_"
+DOG_WS_PREFIX = "dog_ws_"
+SIGMA_INFIX = "_sigma_"
+SIGMA_RATIO_INFIX = "_ratio_"
+CUSTOM_WS_PREFIX = "custom_ws_"
+CUSTOM_DIGEST_LEN = 8
@@ -6,9 +6,8 @@ SUBDIR_NOT_FOUND_ERROR = (
     "Subdir not found, check submission integrity and subset dir names."
 )
 CONVOLUTION_TYPE_ERROR = "Unsupported convolution type."
-UNREACHABLE_ERROR = (
-    "This is a placeholder function to conform"
-    " with duck typing. We should never reach this implementation."
-)
+CUSTOM_KERNEL_ERROR = "The custom convolution needs --kernel_taps."
+
+OUTPUT_INCOMPLETE_ERROR = "Convolution submission incomplete, see above."
 
 META_YAML_WARNING = "Warning: unable to find meta.yaml in submission."
@@ -0,0 +1,190 @@
+import hashlib
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+from convolution_submission_gen_constants import *
+from convolution_submission_gen_errors import *
+from convolution_submission_gen_model import GeneratorArgs
+
+
+# Kernels are 1-D, of odd length, and applied along time to every dimension:
+# tap k weighs frame t - len(taps) // 2 + k in output frame t, as in a
+# correlation (the same as a convolution for symmetric kernels).
+class Kernel(NamedTuple):
+    taps: np.ndarray
+    divisor: float = 1.0  # the weighted sum is divided by it
+
+
+class KernelType(NamedTuple):
+    # kernels applied one after the other (each with its own padding)
+    kernels: Callable[[GeneratorArgs], list[Kernel]]
+    # name of the output dir under output_path/convolution_type
+    window_s_name: Callable[[GeneratorArgs], str]
+
+
+KERNEL_REGISTRY: dict[str, KernelType] = {}
+
+
+def register_kernel(
+    convolution_type: str,
+    kernels: Callable[[GeneratorArgs], list[Kernel]],
+    window_s_name: Callable[[GeneratorArgs], str],
+):
+    KERNEL_REGISTRY[convolution_type] = KernelType(kernels, window_s_name)
+
+
+def kernel_type(convolution_type: str) -> KernelType:
+    if convolution_type not in KERNEL_REGISTRY:
+        raise ValueError(CONVOLUTION_TYPE_ERROR)
+    return KERNEL_REGISTRY[convolution_type]
+
+
+def correlate(padded_m: np.ndarray, kernel: Kernel) -> np.ndarray:
+    """Applies the kernel at every position where it fits in padded_m, i.e.
+    returns len(padded_m) - len(kernel.taps) + 1 frames. Short kernels are
+    applied directly, as a sum of shifted frames, long ones through the FFT,
+    whose cost does not grow with the kernel length.
+    """
+    if len(kernel.taps) < FFT_MIN_TAPS:
+        conv_m = _correlate_direct(padded_m, kernel.taps)
+    else:
+        conv_m = _correlate_fft(padded_m, kernel.taps)
+    if kernel.divisor != 1:
+        conv_m /= kernel.divisor
+    return conv_m
+
+
+def _correlate_direct(padded_m: np.ndarray, taps: np.ndarray) -> np.ndarray:
+    n = padded_m.shape[0] - len(taps) + 1
+    conv_m = np.zeros((n, padded_m.shape[1]))
+    for k, weight in enumerate(taps):
+        conv_m += weight * padded_m[k : k + n]
+    return conv_m
+
+
+def _correlate_fft(padded_m: np.ndarray, taps: np.ndarray) -> np.ndarray:
+    n, window_s = padded_m.shape[0], len(taps)
+    # power of 2 at least as long as the full convolution, so nothing wraps around
+    fft_n = 1 << int(np.ceil(np.log2(n + window_s - 1)))
+    spectrum = np.fft.rfft(padded_m, fft_n, axis=0)
+    spectrum *= np.fft.rfft(taps[::-1], fft_n)[:, None]
+    return np.fft.irfft(spectrum, fft_n, axis=0)[window_s - 1 : n]
+
+
+# KERNELS
+def check_window_odd(window_s: int):
+    if window_s % 2 == 0:
+        raise NotImplementedError(WINDOW_SIZE_EVEN_ERROR)
+
+
+def running_mean_kernel(window_s: int) -> Kernel:
+    check_window_odd(window_s)
+    return Kernel(np.ones(window_s), window_s)
+
+
+def laplacian_kernel(window_s: int, max_sharpen: bool) -> Kernel:
+    """-1 on every neighbour and a center weight that makes it a sharpening
+    filter: (-1, 4, -1), or (-1, 8, -1) with max_sharpen, for window size 3.
+    """
+    check_window_odd(window_s)
+    taps = -np.ones(window_s)
+    center_weight = LAPLACIAN_MAX_SHARPEN_CENTER if max_sharpen else LAPLACIAN_CENTER
+    taps[window_s // 2] = center_weight * (window_s - 1)
+    return Kernel(taps)
+
+
+def gaussian_taps(window_s: int, sigma: float) -> np.ndarray:
+    """Normalized gaussian over the window. A sigma of 0 stands for the
+    default, window_s / GAUSSIAN_WINDOW_SIGMAS.
+    """
+    check_window_odd(window_s)
+    sigma = sigma or window_s / GAUSSIAN_WINDOW_SIGMAS
+    t = np.arange(window_s) - window_s // 2
+    taps = np.exp(-0.5 * (t / sigma) ** 2)
+    return taps / taps.sum()
+
+
+def gaussian_kernel(window_s: int, sigma: float) -> Kernel:
+    return Kernel(gaussian_taps(window_s, sigma))
+
+
+def difference_of_gaussians_kernel(
+    window_s: int, sigma: float, sigma_ratio: float
+) -> Kernel:
+    """Gaussian of sigma minus gaussian of sigma * sigma_ratio, on the same
+    window: a band-pass filter along time.
+    """
+    sigma = sigma or window_s / GAUSSIAN_WINDOW_SIGMAS
+    return Kernel(
+        gaussian_taps(window_s, sigma)
+        - gaussian_taps(window_s, sigma * sigma_ratio)
+    )
+
+
+def custom_kernel(kernel_taps: tuple[float, ...]) -> Kernel:
+    if not kernel_taps:
+        raise ValueError(CUSTOM_KERNEL_ERROR)
+    check_window_odd(len(kernel_taps))
+    return Kernel(np.array(kernel_taps, dtype=float))
+
+
+def custom_kernel_name(kernel_taps: tuple[float, ...]) -> str:
+    # The taps do not fit in a dir name, a digest of them does
+    digest = hashlib.sha1(repr(tuple(kernel_taps)).encode()).hexdigest()
+    return f"{CUSTOM_WS_PREFIX}{len(kernel_taps)}_{digest[:CUSTOM_DIGEST_LEN]}"
+
+
+def _laplacian_name(args: GeneratorArgs) -> str:
+    window_s = f"{LAPL_WS_PREFIX}{args.window_s_laplacian}"
+    if args.max_sharpen:
+        window_s += MAX_SHARPEN_SUFFIX
+    return window_s
+
+
+def _sigma_name(sigma: float) -> str:
+    return f"{SIGMA_INFIX}{sigma:g}" if sigma else ""
+
+
+register_kernel(
+    RUNNING_MEAN,
+    lambda args: [running_mean_kernel(args.window_s_running_mean)],
+    lambda args: f"{AV_WS_PREFIX}{args.window_s_running_mean}",
+)
+register_kernel(
+    LAPLACIAN,
+    lambda args: [laplacian_kernel(args.window_s_laplacian, args.max_sharpen)],
+    _laplacian_name,
+)
+register_kernel(
+    BLUR_THEN_SHARPEN,
+    lambda args: [
+        running_mean_kernel(args.window_s_running_mean),
+        laplacian_kernel(args.window_s_laplacian, args.max_sharpen),
+    ],
+    lambda args: f"{AV_WS_PREFIX}{args.window_s_running_mean}_{_laplacian_name(args)}",
+)
+register_kernel(
+    GAUSSIAN,
+    lambda args: [gaussian_kernel(args.window_s_running_mean, args.sigma)],
+    lambda args: (
+        f"{GAUSS_WS_PREFIX}{args.window_s_running_mean}{_sigma_name(args.sigma)}"
+    ),
+)
+register_kernel(
+    DIFFERENCE_OF_GAUSSIANS,
+    lambda args: [
+        difference_of_gaussians_kernel(
+            args.window_s_running_mean, args.sigma, args.sigma_ratio
+        )
+    ],
+    lambda args: (
+        f"{DOG_WS_PREFIX}{args.window_s_running_mean}{_sigma_name(args.sigma)}"
+        f"{SIGMA_RATIO_INFIX}{args.sigma_ratio:g}"
+    ),
+)
+register_kernel(
+    CUSTOM,
+    lambda args: [custom_kernel(args.kernel_taps)],
+    lambda args: custom_kernel_name(args.kernel_taps),
+)
@@ -1,8 +1,10 @@
-from enum import Enum, auto
 from typing import NamedTuple
 
 import numpy as np
 
+import convolution_submission_gen_paths  # before sharding
+from sharding import NO_SHARDING, Shard
+
 
 ## ConvolutionSubmissionGenerator models
 class GeneratorArgs(NamedTuple):
@@ -12,12 +14,13 @@ class GeneratorArgs(NamedTuple):
     window_s_running_mean: int
     max_sharpen: bool
     copy_meta: bool
-
-
-class Convolution(Enum):
-    RUNNING_MEAN = auto()
-    LAPLACIAN = auto()
-    BLUR_THEN_SHARPEN = auto()  # i.e. running_mean then laplacian
+    batch_size: int = 1  # number of files convolved in a single pass
+    io_threads: int = 0  # 0: read, convolve and write sequentially
+    shard: Shard = NO_SHARDING  # only process the files of this shard
+    window_s_laplacian: int = 3
+    sigma: float = 0.0  # of the gaussians, 0: window size / 6
+    sigma_ratio: float = 1.6  # of the difference of gaussians
+    kernel_taps: tuple[float, ...] = ()  # of the custom kernel
 
 
 class SubmissionFilePath(NamedTuple):
@@ -25,6 +28,11 @@ class SubmissionFilePath(NamedTuple):
     absolute_path: str
 
 
+class LoadedBatch(NamedTuple):
+    files: list[SubmissionFilePath]
+    representations: list[np.ndarray]
+
+
 class FileOutput(NamedTuple):
     absolute_file_path: str
     representations: np.ndarray
@@ -32,3 +40,9 @@ class FileOutput(NamedTuple):
 
 class SubsetOutput(NamedTuple):
     file_outputs: list[FileOutput]
+
+
+class VerificationResult(NamedTuple):
+    n_expected: int
+    missing: list[str]  # absolute paths
+    unexpected: list[str]  # absolute paths
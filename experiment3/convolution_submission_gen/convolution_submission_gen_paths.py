@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The sharding rule and the read/write pipeline are shared with mapcode: every
+# module of the generator that needs them imports this module first, so that
+# they can be imported on their own, not only through convolution_submission_gen.py.
+MAPCODE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mapcode")
+if MAPCODE_PATH not in sys.path:
+    sys.path.append(MAPCODE_PATH)
@@ -0,0 +1,109 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from knn_search import (COSINE, EUCLIDEAN, KL, KL_SYMMETRIC, average_precisions,
+                        knn, neighbour_labels, not_lone_query_mask, prepared)
+
+# Approximate nearest neighbours with a local (CPU) faiss index, for
+# evaluations too large for the exact search of knn_search.
+IVF = 'ivf'  # inverted file: k-means cells, only nprobe cells are searched
+HNSW = 'hnsw'  # graph based
+ANN_INDEXES = (IVF, HNSW)
+SEARCH_BLOCK_SIZE = 4096  # queries per faiss search call, to cap memory
+TRAINING_POINTS_PER_CELL = 256
+
+
+class AnnParams(NamedTuple):
+    index: str  # one of ANN_INDEXES
+    nlist: int  # IVF cells, 0 for 4 * sqrt(N)
+    nprobe: int  # IVF cells searched per query
+    hnsw_m: int  # HNSW neighbours per node
+    ef_search: int  # HNSW search depth
+    check_queries: int  # queries for which the exact search is also run
+    seed: int = 0
+
+
+def search_vectors(embeddings, metric):
+    '''Rewrite every metric as a faiss search. Cosine and euclidean are native;
+    for KL, minimizing KL(p||q) over q amounts to maximizing p.log q, and
+    symmetric KL to maximizing a dot product of augmented vectors:
+    [p, log p, -p.log p, 1].[log q, q, 1, -q.log q] = -(KL(p||q) + KL(q||p)).
+    Returns: (query vectors, database vectors, use inner product).'''
+    prep = prepared(embeddings, metric)
+    if metric == COSINE:
+        return prep['X'], prep['X'], True
+    if metric == EUCLIDEAN:
+        return prep['X'], prep['X'], False
+    P, log_P, neg_entropy = prep['P'], prep['log_P'], prep['neg_entropy']
+    if metric == KL:
+        return P, log_P, True
+    ones = np.ones((len(P), 1), dtype=np.float32)
+    queries = np.hstack((P, log_P, -neg_entropy[:, None], ones))
+    database = np.hstack((log_P, P, ones, -neg_entropy[:, None]))
+    return queries, database, True
+
+
+def build_index(database, inner_product: bool, ann_params: AnnParams):
+    import faiss
+    d = database.shape[1]
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if inner_product else faiss.METRIC_L2
+    if ann_params.index == HNSW:
+        index = faiss.IndexHNSWFlat(d, ann_params.hnsw_m, faiss_metric)
+        index.hnsw.efSearch = ann_params.ef_search
+        index.add(database)
+        return index
+    if ann_params.index != IVF:
+        raise ValueError(f'Unsupported ANN index {ann_params.index}, choose from {ANN_INDEXES}.')
+    nlist = ann_params.nlist or int(4 * np.sqrt(len(database)))
+    quantizer = faiss.IndexFlat(d, faiss_metric)
+    index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss_metric)
+    rng = np.random.default_rng(ann_params.seed)
+    n_train = min(len(database), nlist * TRAINING_POINTS_PER_CELL)
+    index.train(database[rng.choice(len(database), n_train, replace=False)])
+    index.add(database)
+    index.nprobe = ann_params.nprobe
+    return index
+
+
+def ann_knn(embeddings, k, metric, ann_params: AnnParams):
+    '''Approximate counterpart of knn_search.knn, for all the embeddings.
+    Neighbours the index could not find are -1.'''
+    queries, database, inner_product = search_vectors(embeddings, metric)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    database = np.ascontiguousarray(database, dtype=np.float32)
+    index = build_index(database, inner_product, ann_params)
+    knn_ids = np.empty((len(queries), k), dtype=np.int64)
+    for b in range(0, len(queries), SEARCH_BLOCK_SIZE):
+        block = np.arange(b, min(b + SEARCH_BLOCK_SIZE, len(queries)))
+        _, ids = index.search(queries[block], k + 1)
+        # drop the query itself, wherever it was found (if at all)
+        is_self = ids == block[:, None]
+        order = np.argsort(is_self, axis=1, kind='stable')
+        knn_ids[block] = np.take_along_axis(ids, order, axis=1)[:, :k]
+    return knn_ids
+
+
+def exactness_check(embeddings, labels, knn_ids, metric, ann_params: AnnParams):
+    '''Run the exact search on a random sample of the queries and compare with
+    the approximate neighbours knn_ids (of all the queries).
+    Returns: a dict with the MAP of the sample for both searches, their
+    difference and the recall of the approximate neighbours.'''
+    candidates = np.flatnonzero(not_lone_query_mask(labels))
+    rng = np.random.default_rng(ann_params.seed)
+    n = min(ann_params.check_queries, len(candidates))
+    query_ids = np.sort(rng.choice(candidates, n, replace=False))
+    k = knn_ids.shape[1]
+    exact_ids = knn(embeddings, k, metric, query_ids)
+    approx_ids = knn_ids[query_ids]
+    exact_map = float(np.mean(average_precisions(labels[exact_ids], labels[query_ids])))
+    approx_map = float(np.mean(average_precisions(neighbour_labels(approx_ids, labels),
+                                                  labels[query_ids])))
+    found = [len(np.intersect1d(e, a)) for e, a in zip(exact_ids, approx_ids)]
+    return {
+        'n_queries': int(n),
+        'exact_MAP': exact_map,
+        'approximate_MAP': approx_map,
+        'MAP_gap': exact_map - approx_map,
+        'recall': float(np.sum(found) / (n * k)) if n else float('nan'),
+    }
@@ -0,0 +1,70 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Startup check for the command line scripts: torch, tqdm, yaml and faiss are
+# imported in the functions that need them, so that argument errors and -h do
+# not pay for loading them. Run `python check_startup.py` after touching the
+# imports; it exits with status 1 if a heavy module is imported at startup or
+# if a script takes longer than the budget to print its help.
+SCRIPTS = ['compute_map_from_dir.py', 'map_feature_extractor.py',
+           'validate_submission.py', 'watch_evaluator.py']
+HEAVY_MODULES = ('torch', 'tqdm', 'yaml', 'faiss')
+BUDGET_S = 1.0  # numpy alone takes ~0.1-0.2 s, torch alone several seconds
+
+def startup_imports(script_path: str) -> tuple[float, set[str]]:
+    '''Runs `python -X importtime script -h`.
+    Returns: the wall time and the top-level packages imported.'''
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', script_path, '-h'],
+                               capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f'{script_path} -h failed:\n{completed.stderr}')
+    # 'import time: self [us] | cumulative | imported package', nested imports indented
+    packages = {line.split('|')[-1].strip().split('.')[0]
+                for line in completed.stderr.splitlines() if line.startswith('import time:')}
+    return elapsed, packages
+
+def check_startup(budget_s: float) -> list[str]:
+    '''Returns: the problems found, empty if none.'''
+    problems = []
+    mapcode_dir = os.path.dirname(os.path.abspath(__file__))
+    for script in SCRIPTS:
+        try:
+            elapsed, packages = startup_imports(os.path.join(mapcode_dir, script))
+        except RuntimeError as e:
+            # e.g. a heavy module imported at startup and not installed here
+            problems.append(str(e))
+            continue
+        heavy = sorted(packages.intersection(HEAVY_MODULES))
+        print(f'{script}: {elapsed:.2f} s' + (f', imports {", ".join(heavy)}' if heavy else ''))
+        if heavy:
+            problems.append(f'{script} imports {", ".join(heavy)} at startup.')
+        if elapsed > budget_s:
+            problems.append(f'{script} -h took {elapsed:.2f} s, the budget is {budget_s} s.')
+    return problems
+
+def main(argv):
+    description = (f"Check that the mapcode scripts do not import {', '.join(HEAVY_MODULES)}"
+                   " at startup and print their help within a time budget.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--budget_s",
+        type=float,
+        default=BUDGET_S,
+        help="Maximum time, in s, for each script to print its help."
+    )
+    cmdlineargs = parser.parse_args(argv)
+    problems = check_startup(cmdlineargs.budget_s)
+    for p in problems:
+        print(f'FAILED: {p}')
+    if problems:
+        sys.exit(1)
+    print('OK.')
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
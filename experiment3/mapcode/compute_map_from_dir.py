@@ -1,34 +1,46 @@
 # This code is a slightly modified version of code by Robin Algayres
 
-import tqdm
 import argparse
 import sys
 import os
 from pathlib import Path
-import torch
-from torch import nn
 import numpy as np
-from pytorch_metric_learning.utils.accuracy_calculator import AccuracyCalculator
 import json
 from dataclasses import dataclass
+from typing import NamedTuple
 from datetime import datetime
+# torch, tqdm (and faiss, see ann_search) are imported in the functions that
+# need them, so that argument errors and -h do not pay for loading them.
+from word_index import WORD_INDEX_F_NAME, iter_word_frames, read_word_index
+from knn_search import (COSINE, METRICS, average_precisions, knn, n_neighbours,
+                        neighbour_labels, not_lone_query_mask)
+from ann_search import ANN_INDEXES, AnnParams, ann_knn, exactness_check
+from map_feature_extractor import get_submission_params, metayaml_file
+from sharding import NO_SHARDING, Shard, add_parser_shard_args, in_shard, parse_shard
+from map_statistics import (BOOTSTRAP_UNITS, QUERY, bootstrap_maps, confidence_interval,
+                            map_by_frequency, per_label_map)
 
 @dataclass
 class MapResults:
     source: str
     MAP_meanpooling: float
     MAP_maxpooling: float
+    metric: str = COSINE
 
+class WordFeatures(NamedTuple):
+    meanpool: np.ndarray
+    maxpool: np.ndarray
+    labels: np.ndarray  # label id of each word
+    label2ind: dict[str, int]
+    word_ids: list[str]  # to check that shards do not overlap
 
-def normalize(data):
-    '''Normalize numpy array data in-place.'''
-    epsilon = 0.00000001
-    norm = np.sqrt(np.sum(np.power(data, 2), axis=1))
-    data /= (norm[:, None]+epsilon)
-    return data
+class QueryResults(NamedTuple):
+    aps: np.ndarray  # average precision of each (non lone) query
+    query_labels: np.ndarray
+    ann_check: dict | None  # see ann_search.exactness_check
 
 
-def map_at_r(embeddings, labels):
+def map_at_r(embeddings, labels, metric=COSINE):
     r"""
     Compute the MAP@R as defined in section 3.2 of https://arxiv.org/pdf/2003.08505.pdf
 
@@ -36,41 +48,175 @@ def map_at_r(embeddings, labels):
         - embeddings (2D numpy array): shape = (N,d), contains the embeddings to evaluate
         - labels (1D numpy array): shape =(N,), contains the labels.
                                    Each element should be an integer.
+        - metric (str): distance used to find the neighbours, one of knn_search.METRICS.
+                        Should be the one declared by the submission.
     Returns:
         - mean_average_precision_at_r (float): the value of the MAP@R
     """
+    aps = query_average_precisions(embeddings, labels, metric).aps
+    # no query with a match to retrieve: 0, as pytorch_metric_learning did
+    return float(np.mean(aps)) if len(aps) else 0.0
 
-    k_faiss = np.bincount(labels.astype(int)).max()
-    k_faiss = int(k_faiss)
-    if k_faiss > 2047:  # if k_faiss is larger than 2048
-        # it runs on CPU
-        k_faiss = 2047
-
-    # Initialize the calculator
-    calculator = AccuracyCalculator(
-        include=(), exclude=(), avg_of_avgs=False, k=k_faiss)
-    # Insure that the type of the numpy array is float32 for faiss
+def query_average_precisions(embeddings, labels, metric=COSINE, ann_params: AnnParams | None = None):
+    '''Average precision of each query, from a single kNN pass. Their mean is
+    the MAP@R; map_statistics derives confidence intervals and breakdowns from them.
+    With ann_params, the kNN is approximate (see ann_search) and checked against
+    the exact search on a sample of the queries.
+    Returns: the average precisions and the labels of the queries, lone queries
+    excluded, and the result of the exactness check (None for the exact search).'''
     X = np.float32(embeddings)
-    X = normalize(X)  # embeddings mut be normalize before FAISS
-    # because FAISS only compute the dot
-    # product and not the cosine distance
     if np.isnan(X).any() or np.isinf(X).any():
         print(np.sum(X))
         print('error')
         sys.exit()
 
-    y = np.float32(labels)
-    # Compute the MAP@R
-    metric_name = 'mean_average_precision'
-    score = calculator.get_accuracy(
-        query=X,
-        reference=X,
-        query_labels=y,
-        reference_labels=y,
-        embeddings_come_from_same_source=True,
-        include=[metric_name],
-    )
-    return score[metric_name]
+    labels = labels.astype(int)
+    mask = not_lone_query_mask(labels)
+    if not mask.any():
+        return QueryResults(np.empty(0), np.empty(0, int), None)
+    k = n_neighbours(labels)
+    ann_check = None
+    if ann_params is None:
+        knn_ids = knn(X, k, metric)
+    else:
+        knn_ids = ann_knn(X, k, metric, ann_params)
+        ann_check = exactness_check(X, labels, knn_ids, metric, ann_params)
+    aps = average_precisions(neighbour_labels(knn_ids, labels), labels)
+    return QueryResults(aps[mask], labels[mask], ann_check)
+
+def pooling_statistics(aps, query_labels, ind2label: dict[int, str],
+                       n_resamples: int, bootstrap_unit: str, confidence: float):
+    '''Extended results for one pooling: MAP (0 if there is no query, i.e.
+    every word is alone), bootstrap confidence interval (None without
+    resamples), MAP per word and MAP by word frequency.'''
+    maps = bootstrap_maps(aps, query_labels, n_resamples, bootstrap_unit)
+    return {
+        'MAP': float(np.mean(aps)) if len(aps) else 0.0,
+        'confidence_interval': confidence_interval(maps, confidence),
+        'by_frequency': {bucket: {'MAP': m, 'n_tokens': n, 'n_words': n_words}
+                         for bucket, (m, n, n_words) in map_by_frequency(aps, query_labels).items()},
+        'per_word': {ind2label[l]: {'MAP': m, 'n_tokens': n}
+                     for l, (m, n) in per_label_map(aps, query_labels).items()},
+    }
+
+def submission_metric(feature_dir: str):
+    '''Metric declared in the meta.yaml that map_feature_extractor copies
+    next to the features, cosine if there is none.'''
+    yaml_response = metayaml_file(feature_dir)
+    if not yaml_response:
+        print(f'WARNING! No meta.yaml in {feature_dir}, using the {COSINE} metric.')
+        return COSINE
+    featuredirname = os.path.basename(os.path.normpath(feature_dir))
+    return get_submission_params(yaml_response.yaml_file, featuredirname).metric
+
+def label_id(label: str, label2ind: dict[str, int]) -> int:
+    if label not in label2ind:
+        label2ind[label] = len(label2ind)+1
+    return label2ind[label]
+
+def word_features(meanpool: list, maxpool: list, label_names: list[str], word_ids: list[str]) -> WordFeatures:
+    labels, label2ind = [], {}
+    for label in label_names:
+        labels.append(label_id(label, label2ind))
+    if not word_ids:
+        return WordFeatures(np.empty((0, 0), np.float32), np.empty((0, 0), np.float32),
+                            np.empty(0, int), label2ind, [])
+    return WordFeatures(np.stack(meanpool), np.stack(maxpool), np.array(labels), label2ind, word_ids)
+
+def load_features_from_dir(feature_dir, shard: Shard = NO_SHARDING) -> WordFeatures:
+    '''Load word features saved one word per file by map_feature_extractor,
+    only for the utterances of the shard.'''
+    import torch
+    import tqdm
+    label_names, word_ids = [], []
+    maxpool = []
+    meanpool = []
+    for fid in tqdm.tqdm(os.listdir(feature_dir), mininterval=30, maxinterval=39):
+        if '.txt' not in fid:
+            continue
+        # '{file_name}_{start}_{end}_{gold_label}.txt'
+        if not in_shard(fid.split('_')[0], shard):
+            continue
+        file_path = os.path.join(feature_dir, fid)
+
+        frames = []
+        with open(file_path) as buf:
+            for line in buf:
+                frames.append([float(frame)
+                              for frame in line.rstrip().split(' ')])
+            if len(frames) == 0:
+              continue
+        frames = torch.tensor(frames)
+        maxpool.append(torch.max(frames, dim=0).values.numpy())
+        meanpool.append(torch.mean(frames, dim=0).numpy())
+
+        label_names.append(fid.split('_')[-1].split('.')[0])
+        word_ids.append(fid)
+    return word_features(meanpool, maxpool, label_names, word_ids)
+
+def load_features_from_index(index_path, shard: Shard = NO_SHARDING) -> WordFeatures:
+    '''Load word features through a word index (map_feature_extractor --index_only),
+    reading the frames from the memory-mapped submission files, only for the
+    utterances of the shard.'''
+    import tqdm
+    word_index = read_word_index(index_path)
+    word_index = word_index._replace(rows=[r for r in word_index.rows if in_shard(r.file_name, shard)])
+    label_names, word_ids = [], []
+    maxpool = []
+    meanpool = []
+    for word in tqdm.tqdm(iter_word_frames(word_index), total=len(word_index.rows),
+                          mininterval=30, maxinterval=39):
+        maxpool.append(word.frames.max(axis=0))
+        meanpool.append(word.frames.mean(axis=0))
+        label_names.append(word.row.gold_label)
+        word_ids.append(' '.join(str(x) for x in word.row))
+    return word_features(meanpool, maxpool, label_names, word_ids)
+
+def load_word_features(feature_dir, shard: Shard = NO_SHARDING) -> WordFeatures:
+    index_path = os.path.join(feature_dir, WORD_INDEX_F_NAME)
+    if os.path.isfile(index_path):
+        print(f'Loading features through word index {index_path}')
+        return load_features_from_index(index_path, shard)
+    print(f'Loading features from {feature_dir}')
+    return load_features_from_dir(feature_dir, shard)
+
+# Partial embedding stores: pooled features of one shard, merged before evaluation
+def partial_store_path(partial_dir: str, shard: Shard) -> str:
+    return os.path.join(partial_dir, f'shard_{shard.index}_of_{shard.count}.npz')
+
+def save_partial_store(features: WordFeatures, shard: Shard, partial_dir: str):
+    Path(partial_dir).mkdir(parents=True, exist_ok=True)
+    ind2label = {i: l for l, i in features.label2ind.items()}
+    np.savez(partial_store_path(partial_dir, shard),
+             meanpool=features.meanpool,
+             maxpool=features.maxpool,
+             labels=np.array([ind2label[l] for l in features.labels], dtype=str),
+             word_ids=np.array(features.word_ids, dtype=str))
+
+def merge_partial_stores(partial_dir: str) -> WordFeatures:
+    '''Combine the partial stores of all the shards, checking that every shard
+    is there and that no word was loaded by two shards.'''
+    store_names = [f for f in os.listdir(partial_dir) if f.startswith('shard_') and f.endswith('.npz')] \
+        if os.path.isdir(partial_dir) else []
+    shards = {parse_shard(f.removeprefix('shard_').removesuffix('.npz').replace('_of_', '/'))
+              for f in store_names}
+    counts = {s.count for s in shards}
+    if len(counts) != 1:
+        raise ValueError(f'Expected the partial stores of one sharding in {partial_dir}, found {sorted(shards)}.')
+    count = counts.pop()
+    missing = sorted(set(range(count)) - {s.index for s in shards})
+    if missing:
+        raise ValueError(f'Missing partial stores in {partial_dir} for shards {missing} of {count}.')
+    meanpool, maxpool, label_names, word_ids = [], [], [], []
+    for i in range(count):
+        with np.load(partial_store_path(partial_dir, Shard(i, count))) as store:
+            meanpool.extend(store['meanpool'])
+            maxpool.extend(store['maxpool'])
+            label_names.extend(store['labels'].tolist())
+            word_ids.extend(store['word_ids'].tolist())
+    if len(set(word_ids)) != len(word_ids):
+        raise ValueError(f'Some words are in several partial stores in {partial_dir}.')
+    return word_features(meanpool, maxpool, label_names, word_ids)
 
 def save_results(map_results: MapResults, output_path: str):
     Path(output_path).mkdir(parents=True, exist_ok=True)
@@ -78,11 +224,17 @@ def save_results(map_results: MapResults, output_path: str):
     with open(result_file, "w") as f:
         json.dump(vars(map_results), f, indent=2)
 
+def save_extended_results(extended_results: dict, output_path: str):
+    result_file = os.path.join(output_path, 'map_results_extended.json')
+    with open(result_file, "w") as f:
+        json.dump(extended_results, f, indent=2)
+
 def add_parser_single_job_args(parser: argparse.ArgumentParser):
     parser.add_argument(
         "feature_dir",
         type=str,
-        help=("Path to the directory where the features are organized by word.")
+        help=("Path to the directory where the features are organized by word, or where"
+              " map_feature_extractor.py --index_only wrote its word index.")
     )
 
     parser.add_argument(
@@ -91,12 +243,102 @@ def add_parser_single_job_args(parser: argparse.ArgumentParser):
         help="Path where the results of the map calculation will be written. A dir with the original submission name will be created here."
     )
 
+    parser.add_argument(
+        "--metric",
+        type=str,
+        default=None,
+        choices=METRICS,
+        help=("Distance used for the MAP. By default, the metric declared in the meta.yaml"
+              " copied by map_feature_extractor.py next to the features (cosine if none).")
+    )
+
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=1000,
+        help=("Number of bootstrap resamples for the confidence intervals of map_results_extended.json."
+              " 0 skips them (null intervals).")
+    )
+
+    parser.add_argument(
+        "--bootstrap_unit",
+        type=str,
+        default=QUERY,
+        choices=BOOTSTRAP_UNITS,
+        help="Resample the queries (word tokens) or the word types, with all their tokens."
+    )
+
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the bootstrap intervals."
+    )
+
+    parser.add_argument(
+        "--ann",
+        type=str,
+        default=None,
+        choices=ANN_INDEXES,
+        help=("Use an approximate nearest neighbour index (faiss, CPU) instead of the exact"
+              " search, for large evaluations. The exact search is still run on"
+              " --ann_check_queries queries to measure the error on the MAP.")
+    )
+
+    parser.add_argument(
+        "--ann_nlist",
+        type=int,
+        default=0,
+        help="ivf: number of cells (0: 4 * sqrt(number of words)). Fewer cells are faster to search, less exact."
+    )
+
+    parser.add_argument(
+        "--ann_nprobe",
+        type=int,
+        default=16,
+        help="ivf: number of cells searched per query. More is slower, more exact."
+    )
+
+    parser.add_argument(
+        "--ann_hnsw_m",
+        type=int,
+        default=32,
+        help="hnsw: number of neighbours per node of the graph."
+    )
+
+    parser.add_argument(
+        "--ann_ef_search",
+        type=int,
+        default=2048,
+        help="hnsw: search depth, at least the number of neighbours retrieved. More is slower, more exact."
+    )
+
+    parser.add_argument(
+        "--ann_check_queries",
+        type=int,
+        default=1000,
+        help="Number of randomly sampled queries on which the approximate and exact MAP are compared."
+    )
+
+    add_parser_shard_args(parser, ("Only load and pool the words of the utterances of shard i of N"
+                                   " (by a stable hash of the utterance name) and save them as a partial"
+                                   " store in output_path, without evaluating. See --merge."))
+
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help=("Evaluate the combination of the partial stores saved by the --shard runs,"
+              " after checking that every shard is there and that no word appears twice.")
+    )
+
 def main(argv):
     #feature_dir=sys.argv[1] # path to source directory
     description = ("Compute and save map results to file.")
     parser = argparse.ArgumentParser(description=description)
     add_parser_single_job_args(parser)
     cmdlineargs = parser.parse_args(argv)
+    if cmdlineargs.bootstrap < 0:
+        parser.error("--bootstrap must be >= 0 (0: no confidence intervals).")
     # dev-clean only for now
     sub_dir = 'phonetic/dev-clean'
     feature_dir = os.path.join(cmdlineargs.feature_dir, sub_dir)
@@ -104,47 +346,64 @@ def main(argv):
     featuredirname = os.path.basename(os.path.normpath(cmdlineargs.feature_dir))
     output_path = os.path.join(cmdlineargs.output_path, featuredirname, sub_dir)
     
-    labels, label2ind = [], {}
-    maxpool = []
-    meanpool = []
-    c = 0
+    partial_dir = os.path.join(output_path, 'partial_stores')
+    # before the slow feature loading, so that a typo in the meta.yaml fails fast
+    metric = cmdlineargs.metric or submission_metric(cmdlineargs.feature_dir)
+    if metric not in METRICS:
+        parser.error(f"Unsupported metric {metric} in the meta.yaml of {cmdlineargs.feature_dir},"
+                     f" choose from {', '.join(METRICS)} (or pass --metric).")
 
     print("Date and time of run start:", datetime.now().strftime("%d/%m/%Y %H:%M"))
-    print(f'Loading features from {feature_dir}')
-    for fid in tqdm.tqdm(os.listdir(feature_dir), mininterval=30, maxinterval=39):
-        if '.txt' not in fid:
-            continue
-        file_path = os.path.join(feature_dir, fid)
-
-        frames = []
-        with open(file_path) as buf:
-            for line in buf:
-                frames.append([float(frame)
-                              for frame in line.rstrip().split(' ')])
-            if len(frames) == 0:
-              continue
-        frames = torch.tensor(frames)
-        maxpool.append(torch.max(frames, dim=0).values.unsqueeze(0))
-        meanpool.append(torch.mean(frames, dim=0).unsqueeze(0))
-
-        label = fid.split('_')[-1].split('.')[0]
-        if label not in label2ind:
-            label2ind[label] = len(label2ind)+1
-        labels.append(label2ind[label])
-        #c+=1
-        #if c>100:
-        #    break
-    maxpool = torch.cat(maxpool, dim=0).numpy()
-    meanpool = torch.cat(meanpool, dim=0).numpy()
-    labels = torch.tensor(labels).numpy()
-    print('computing map on', maxpool.shape)
-    map_value_meanpool = map_at_r(meanpool, labels)
-    print('MAP (meanpooling):', np.around(map_value_meanpool, 3))
-    map_value_maxpool = map_at_r(maxpool, labels)
-    print('MAP (maxpooling):', np.around(map_value_maxpool, 3))
-    map_results = MapResults(feature_dir, map_value_meanpool, map_value_maxpool)
+    if cmdlineargs.merge:
+        print(f'Merging partial stores from {partial_dir}')
+        features = merge_partial_stores(partial_dir)
+    else:
+        features = load_word_features(feature_dir, cmdlineargs.shard)
+        if cmdlineargs.shard.count > 1:
+            save_partial_store(features, cmdlineargs.shard, partial_dir)
+            print(f'Partial store of {len(features.word_ids)} words saved in {partial_dir}.'
+                  ' Run with --merge once all the shards are done.')
+            return
+    meanpool, maxpool, labels, label2ind, _ = features
+    print('computing map on', maxpool.shape, 'with metric', metric)
+    ind2label = {i: l for l, i in label2ind.items()}
+    ann_params = None
+    if cmdlineargs.ann:
+        ann_params = AnnParams(cmdlineargs.ann,
+                               cmdlineargs.ann_nlist,
+                               cmdlineargs.ann_nprobe,
+                               cmdlineargs.ann_hnsw_m,
+                               cmdlineargs.ann_ef_search,
+                               cmdlineargs.ann_check_queries)
+    extended_results = {
+        'source': feature_dir,
+        'metric': metric,
+        'bootstrap': {'n_resamples': cmdlineargs.bootstrap,
+                      'unit': cmdlineargs.bootstrap_unit,
+                      'confidence': cmdlineargs.confidence},
+        'ann': ann_params._asdict() if ann_params else None,
+    }
+    for pooling, pooled in (('meanpooling', meanpool), ('maxpooling', maxpool)):
+        aps, query_labels, ann_check = query_average_precisions(pooled, labels, metric, ann_params)
+        extended_results[pooling] = pooling_statistics(aps, query_labels, ind2label,
+                                                       cmdlineargs.bootstrap,
+                                                       cmdlineargs.bootstrap_unit,
+                                                       cmdlineargs.confidence)
+        if ann_check:
+            extended_results[pooling]['ann_check'] = ann_check
+            print(f'ANN check ({pooling}) on {ann_check["n_queries"]} queries:'
+                  f' exact MAP {np.around(ann_check["exact_MAP"], 3)},'
+                  f' approximate MAP {np.around(ann_check["approximate_MAP"], 3)},'
+                  f' recall {np.around(ann_check["recall"], 3)}')
+        interval = extended_results[pooling]['confidence_interval']
+        interval_s = f' [{np.around(interval[0], 3)}, {np.around(interval[1], 3)}]' if interval else ''
+        print(f'MAP ({pooling}): {np.around(extended_results[pooling]["MAP"], 3)}{interval_s}')
+    map_results = MapResults(feature_dir,
+                             extended_results['meanpooling']['MAP'],
+                             extended_results['maxpooling']['MAP'],
+                             metric)
     save_results(map_results, output_path)
-
+    save_extended_results(extended_results, output_path)
 
 if __name__ == "__main__":
     args = sys.argv[1:]
@@ -0,0 +1,58 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+In = TypeVar("In")
+Loaded = TypeVar("Loaded")
+Out = TypeVar("Out")
+
+
+# Overlaps disk reads and writes with the computation: reads are prefetched
+# and writes flushed by io_threads threads each, while the computation runs in
+# the calling thread. Results come out in the order of items.
+# Also used by convolution_submission_gen.py, which imports it from here.
+def pipelined(
+    items: Iterable[In],
+    read: Callable[[In], Loaded],
+    compute: Callable[[Loaded], Out],
+    write: Callable[[Out], None],
+    io_threads: int,
+) -> Iterator[Out]:
+    """Yields compute(read(item)) for each item, once its write is queued.
+    At most 2 * io_threads reads and 2 * io_threads writes are pending at any
+    time, which caps the memory held by the pipeline. With io_threads=0,
+    everything runs sequentially in the calling thread.
+    """
+    if io_threads <= 0:
+        for item in items:
+            out = compute(read(item))
+            write(out)
+            yield out
+        return
+
+    max_pending = 2 * io_threads
+    with ThreadPoolExecutor(io_threads) as readers, ThreadPoolExecutor(
+        io_threads
+    ) as writers:
+        items_it = iter(items)
+        reads: deque[Future] = deque()
+        writes: deque[Future] = deque()
+
+        def prefetch():
+            while len(reads) < max_pending:
+                try:
+                    reads.append(readers.submit(read, next(items_it)))
+                except StopIteration:
+                    return
+
+        prefetch()
+        while reads:
+            loaded = reads.popleft().result()
+            prefetch()
+            out = compute(loaded)
+            while len(writes) >= max_pending:
+                writes.popleft().result()  # raises the write's error, if any
+            writes.append(writers.submit(write, out))
+            yield out
+        for w in writes:
+            w.result()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import zipfile
+from typing import NamedTuple
+
+import numpy as np
+
+from word_index import frame_ranges
+
+# Compiled form of an item file (one 'file_name start end gold_label' line per
+# word), cached next to it as a .npz so that the text is only parsed once,
+# and kept in memory for all the submissions processed by the same process.
+CACHE_SUFFIX = '.index.npz'
+
+
+class ItemIndex(NamedTuple):
+    file_names: np.ndarray  # str, utterance of each line
+    starts: np.ndarray  # float64, in s
+    ends: np.ndarray  # float64, in s
+    label_ids: np.ndarray  # int, index in labels of each line
+    labels: np.ndarray  # str, sorted vocabulary of gold labels
+
+    def gold_labels(self) -> np.ndarray:
+        return self.labels[self.label_ids]
+
+    def frame_ranges(self, frame_step: float):
+        '''First frame and first frame after each word, for all the lines at once.'''
+        return frame_ranges(self.starts, self.ends, frame_step)
+
+
+_loaded: dict[str, ItemIndex] = {}
+
+
+def load_item_index(item_file_path: str) -> ItemIndex | None:
+    '''Item index of the item file, from memory, from the cache file if it is
+    more recent than the item file, or else parsed and cached.
+    Returns: None if the item file cannot be read.'''
+    item_file_path = os.path.abspath(item_file_path)
+    if not os.path.isfile(item_file_path):
+        return None
+    if item_file_path in _loaded:
+        return _loaded[item_file_path]
+    cache_path = item_file_path + CACHE_SUFFIX
+    item_index = None
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(item_file_path):
+        item_index = read_cache(cache_path)
+    if item_index is None:
+        item_index = compile_item_file(item_file_path)
+        if item_index is None:
+            return None
+        write_cache(cache_path, item_index)
+    _loaded[item_file_path] = item_index
+    return item_index
+
+
+def read_cache(cache_path: str) -> ItemIndex | None:
+    '''Returns: None if the cache cannot be read, e.g. truncated, so that it is
+    compiled again.'''
+    try:
+        with np.load(cache_path) as cached:
+            return ItemIndex(*(cached[field] for field in ItemIndex._fields))
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def write_cache(cache_path: str, item_index: ItemIndex):
+    # Several processes (shards, --jobs workers) may compile the same item file
+    # at once: each writes its own temp file and moves it into place, so that a
+    # reader never sees a partly written cache.
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path),
+                                        prefix=os.path.basename(cache_path) + '.', suffix='.tmp')
+    except OSError:
+        return  # read-only location, the index is only kept in memory
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **item_index._asdict())
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def compile_item_file(item_file_path: str) -> ItemIndex | None:
+    try:
+        with open(item_file_path, 'r') as f:
+            tokens = np.array(f.read().split())
+    except:
+        return None
+    if len(tokens) == 0 or len(tokens) % 4 != 0:
+        return None
+    tokens = tokens.reshape(-1, 4)
+    labels, label_ids = np.unique(tokens[:, 3], return_inverse=True)
+    return ItemIndex(tokens[:, 0],
+                     tokens[:, 1].astype(np.float64),
+                     tokens[:, 2].astype(np.float64),
+                     label_ids,
+                     labels)
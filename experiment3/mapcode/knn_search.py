@@ -0,0 +1,118 @@
+import numpy as np
+
+# Distances declared in the zerospeech meta.yaml (parameters/phonetic/metric)
+COSINE = 'cosine'
+EUCLIDEAN = 'euclidean'
+KL = 'kl'
+KL_SYMMETRIC = 'kl_symmetric'
+METRICS = (COSINE, EUCLIDEAN, KL, KL_SYMMETRIC)
+
+MAX_K = 2047  # same cap as the faiss based evaluation used for the paper
+QUERY_BLOCK_SIZE = 512  # queries per distance matrix block
+EPSILON = 0.00000001
+
+
+def normalize(data):
+    '''Normalize numpy array data in-place.'''
+    norm = np.sqrt(np.sum(np.power(data, 2), axis=1))
+    data /= (norm[:, None]+EPSILON)
+    return data
+
+
+def probabilities(data):
+    '''Turn (pooled) posteriorgrams into proper probability distributions.
+    Max pooling does not preserve the sum to 1, and log(0) must be avoided.'''
+    data = np.clip(data, EPSILON, None)
+    return data / data.sum(axis=1, keepdims=True)
+
+
+def prepared(embeddings, metric):
+    '''Per-metric preprocessing, done once for all the query blocks.
+    Returns: a dict of the arrays used by block_distances.'''
+    X = np.float32(embeddings)
+    if metric == COSINE:
+        return {'X': normalize(X)}
+    if metric == EUCLIDEAN:
+        return {'X': X, 'sq_norms': np.sum(X * X, axis=1)}
+    if metric in (KL, KL_SYMMETRIC):
+        P = probabilities(X)
+        log_P = np.log(P)
+        return {'P': P, 'log_P': log_P, 'neg_entropy': np.sum(P * log_P, axis=1)}
+    raise ValueError(f'Unsupported metric {metric}, choose from {METRICS}.')
+
+
+def block_distances(prep, metric, query_ids):
+    '''Distances (or any monotonic function of them) between the queries
+    query_ids and all the embeddings, as a (len(query_ids), N) matrix.
+    Each metric boils down to one or two matrix products.'''
+    if metric == COSINE:
+        X = prep['X']
+        return -(X[query_ids] @ X.T)
+    if metric == EUCLIDEAN:
+        X, sq_norms = prep['X'], prep['sq_norms']
+        # squared distances, the square root does not change the ranking
+        return sq_norms[query_ids, None] - 2 * (X[query_ids] @ X.T) + sq_norms[None, :]
+    P, log_P, neg_entropy = prep['P'], prep['log_P'], prep['neg_entropy']
+    # KL(p||q) = sum p log p - sum p log q
+    d = neg_entropy[query_ids, None] - P[query_ids] @ log_P.T
+    if metric == KL_SYMMETRIC:
+        d += neg_entropy[None, :] - log_P[query_ids] @ P.T
+    return d
+
+
+def knn(embeddings, k, metric=COSINE, query_ids=None):
+    '''Exact k nearest neighbours of each query, the query itself excluded,
+    computed by blocks of QUERY_BLOCK_SIZE queries to cap memory.
+
+    Parameters:
+        - embeddings (2D numpy array): shape = (N,d)
+        - k (int): number of neighbours
+        - metric (str): one of METRICS
+        - query_ids (1D numpy array): indices of the queries in embeddings,
+                                      all the embeddings by default.
+    Returns:
+        - knn_ids (2D numpy array): shape = (len(query_ids), k), sorted from
+                                    the closest neighbour.
+    '''
+    prep = prepared(embeddings, metric)
+    if query_ids is None:
+        query_ids = np.arange(len(embeddings))
+    knn_ids = np.empty((len(query_ids), k), dtype=np.int64)
+    for b in range(0, len(query_ids), QUERY_BLOCK_SIZE):
+        block_ids = query_ids[b:b + QUERY_BLOCK_SIZE]
+        d = block_distances(prep, metric, block_ids)
+        d[np.arange(len(block_ids)), block_ids] = np.inf  # not its own neighbour
+        candidates = np.argpartition(d, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(d, candidates, axis=1), axis=1)
+        knn_ids[b:b + QUERY_BLOCK_SIZE] = np.take_along_axis(candidates, order, axis=1)
+    return knn_ids
+
+
+def n_neighbours(labels):
+    '''k used for the MAP: the size of the largest class, capped at MAX_K.'''
+    k = int(np.bincount(labels.astype(int)).max())
+    return min(k, MAX_K, len(labels) - 1)
+
+
+def average_precisions(knn_labels, query_labels):
+    '''Average precision of each query over its nearest neighbours, as in
+    pytorch_metric_learning's mean_average_precision: the precision at each
+    correct neighbour, averaged over the correct neighbours (0 if none).'''
+    equality = knn_labels == query_labels[:, None]
+    cumulative_correct = np.cumsum(equality, axis=1)
+    k_idx = np.arange(1, knn_labels.shape[1] + 1)
+    summed_precision = np.sum(cumulative_correct * equality / k_idx, axis=1)
+    n_correct = np.sum(equality, axis=1)
+    return np.where(n_correct > 0, summed_precision / np.maximum(n_correct, 1), 0.0)
+
+
+def not_lone_query_mask(labels):
+    '''Queries whose label appears only once cannot retrieve anything
+    and are left out of the mean.'''
+    return np.bincount(labels.astype(int))[labels.astype(int)] > 1
+
+
+def neighbour_labels(knn_ids, labels):
+    '''labels[knn_ids], with label -1 (never a match) for missing neighbours (-1),
+    as returned by approximate searches.'''
+    return np.where(knn_ids >= 0, labels[knn_ids], -1)
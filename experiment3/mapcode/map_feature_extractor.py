@@ -1,14 +1,21 @@
 import argparse
 from io import TextIOWrapper
 from pathlib import Path
-import sys, os, yaml
-import tqdm
-from typing import NamedTuple
+import sys, os, shutil
+from typing import Iterator, NamedTuple
 import json
+from multiprocessing import Pool
+from io_pipeline import pipelined
+from item_index import ItemIndex, load_item_index
+from sharding import NO_SHARDING, Shard, add_parser_shard_args, in_shard
+from word_index import WORD_INDEX_F_NAME, WordIndex, WordIndexRow, write_word_index
+# yaml and tqdm are imported in the functions that need them, so that
+# argument errors and -h do not pay for loading them.
 
 
 PHONETIC_SUB_DIRS = ['dev-clean', 'dev-other', 'test-clean', 'test-other']
 GOLD_LOC_DIC = "gold_loc_d.json"
+WORKER_TASK_SIZE = 16  # utterances per task sent to a --jobs worker
 
 class YamlResponse(NamedTuple):
     yaml_file: TextIOWrapper
@@ -23,15 +30,37 @@ class ItemFileLineData(NamedTuple):
     start: float
     end: float
     gold_label: str
+    f_start: int  # first frame of the word in the submission file
+    f_end: int  # first frame after the word
 
 class FileOutput(NamedTuple):
     absolute_file_path: str
     representations: list[str]
 
+class VerificationResult(NamedTuple):
+    n_expected: int
+    missing: list[str]  # absolute paths
+    unexpected: list[str]  # absolute paths
+
+class UtteranceLines(NamedTuple):
+    iflds: list[ItemFileLineData]  # all the words of the utterance
+    lines: list[str] | None  # None if the utterance is not in the submission
+
 class ExtractorArgs(NamedTuple):
     submission_path: str
     output_path: str
     item_file_path: str
+    index_only: bool = False
+    jobs: int = 1
+    io_threads: int = 0
+    shard: Shard = NO_SHARDING
+
+class ExtractionContext(NamedTuple):
+    """Everything process_utterances needs, computed once per submission."""
+    phonetic_data_path: str
+    output_phonetic_path: str  # [output_path]/[submissiondirname]/phonetic
+    file_loc_dict: dict[str, str]
+    frame_step: float
 
 def metayaml_file(main_submission_dir: str):
     f_name = 'meta.yaml'
@@ -50,34 +79,23 @@ def metayaml_file(main_submission_dir: str):
                 return YamlResponse(yaml_file, alt_loc.removesuffix(f_name))
     return None
 
-def get_item_file_lines(item_file_path: str):
-    if not os.path.isfile(item_file_path):
-        return None
-    try: 
-        with open(item_file_path, 'r') as f:
-            lines = f.readlines()
-    except:
-        return None
-    else: 
-        return lines
-    
-def process_item_file_line(ifld: ItemFileLineData,
-                           args: ExtractorArgs,
-                           phonetic_data_path: str,
-                           file_loc_dict: dict[str, str],
-                           frame_step: float):
-    # Step 1: Find if a corresponding file exists in the submissions
-    # NB! Not all lines are in the submission sets!
-    if not ifld.file_name in file_loc_dict:
-        return # continue
-    # Step 2: and where
-    subdir = file_loc_dict[ifld.file_name]
+def get_item_file_data(item_index: ItemIndex, frame_step: float) -> list[ItemFileLineData]:
+    # The frame ranges of all the lines in one go, see word_index.frame_ranges for the rounding
+    f_starts, f_ends = item_index.frame_ranges(frame_step)
+    return [ItemFileLineData(*line) for line in zip(item_index.file_names.tolist(),
+                                                    item_index.starts.tolist(),
+                                                    item_index.ends.tolist(),
+                                                    item_index.gold_labels().tolist(),
+                                                    f_starts.tolist(),
+                                                    f_ends.tolist())]
+
+def read_data_file_lines(file_name: str, ctx: ExtractionContext) -> list[str]:
+    subdir = ctx.file_loc_dict[file_name]
     data_file_path = os.path.join(
-        phonetic_data_path,
+        ctx.phonetic_data_path,
         subdir,
-        ifld.file_name + '.txt'
+        file_name + '.txt'
         )
-    # Step 3: Open this file in the submission, read the lines
     if not os.path.isfile(data_file_path):
         raise IOError(f'No file at {data_file_path}, check submission integrity.')
     try:
@@ -85,20 +103,123 @@ def process_item_file_line(ifld: ItemFileLineData,
             lines = f.readlines()
     except:
         raise IOError(f'Failed to read contents of file at {data_file_path}')
-    # Step 4: calculate how many frames to skip at beginning
-    f_start = n_frames_to_skip(ifld.start, frame_step) + 1
-    # Step 5: calculate how many frames to include. 
+    return lines
+
+def word_file_output(ifld: ItemFileLineData,
+                     lines: list[str],
+                     ctx: ExtractionContext) -> FileOutput:
+    # Step 4-5: frames to skip at beginning and to include, see get_item_file_data.
     # And process_file / extract features (line=frame rep)
-    reps = lines[f_start:f_start + n_frames_to_include(ifld.start, ifld.end, frame_step)]
-    # Step6: save result to file in our output dir
-    submissiondirname = os.path.basename(os.path.normpath(args.submission_path))
+    reps = lines[ifld.f_start:ifld.f_end]
+    # Step 6: output file in our output dir (created up front, see create_output_dirs)
+    subdir = ctx.file_loc_dict[ifld.file_name]
     output_f_name = f'{ifld.file_name}_{ifld.start}_{ifld.end}_{ifld.gold_label}'.replace('.', 'dot').replace(',', 'comma')
-    out_path = os.path.join(args.output_path, submissiondirname, 'phonetic', subdir, output_f_name + '.txt')
-    save_file_representations(FileOutput(out_path, reps))
+    out_path = os.path.join(ctx.output_phonetic_path, subdir, output_f_name + '.txt')
+    return FileOutput(out_path, reps)
+
+def create_output_dirs(item_file_data: list[ItemFileLineData], ctx: ExtractionContext):
+    subdirs = {ctx.file_loc_dict[ifld.file_name] for ifld in item_file_data
+               if ifld.file_name in ctx.file_loc_dict}
+    for subdir in subdirs:
+        Path(os.path.join(ctx.output_phonetic_path, subdir)).mkdir(parents=True, exist_ok=True)
+
+def group_by_file(item_file_data: list[ItemFileLineData]) -> list[list[ItemFileLineData]]:
+    """Shard the item file lines by utterance, keeping the item file order.
+    All the words of an utterance are then handled by the same worker."""
+    groups: dict[str, list[ItemFileLineData]] = {}
+    for ifld in item_file_data:
+        groups.setdefault(ifld.file_name, []).append(ifld)
+    return list(groups.values())
+
+def process_utterances(groups: list[list[ItemFileLineData]],
+                       ctx: ExtractionContext,
+                       io_threads: int) -> Iterator[int]:
+    """Extract the words of each utterance, reading each submission file once.
+    With io_threads > 0, reading the next files and writing the word files
+    overlap with the extraction (see io_pipeline).
+    Yields: the number of item file lines handled, utterance by utterance."""
+    def read(iflds: list[ItemFileLineData]) -> UtteranceLines:
+        # NB! Not all lines are in the submission sets!
+        if not iflds[0].file_name in ctx.file_loc_dict:
+            return UtteranceLines(iflds, None)
+        return UtteranceLines(iflds, read_data_file_lines(iflds[0].file_name, ctx))
+
+    def compute(utterance: UtteranceLines) -> list[FileOutput]:
+        if utterance.lines is None:
+            return []
+        return [word_file_output(ifld, utterance.lines, ctx) for ifld in utterance.iflds]
+
+    def write(file_outputs: list[FileOutput]):
+        for file_output in file_outputs:
+            save_file_representations(file_output)
+
+    # pipelined first, so that it runs to completion (and waits for the last writes)
+    for _, group in zip(pipelined(groups, read, compute, write, io_threads), groups):
+        yield len(group)
+
+# Pool workers get the context once, through the initializer
+_worker_ctx: ExtractionContext | None = None
+_worker_io_threads = 0
+
+def _init_worker(ctx: ExtractionContext, io_threads: int):
+    global _worker_ctx, _worker_io_threads
+    _worker_ctx = ctx
+    _worker_io_threads = io_threads
+
+def _process_utterances(groups: list[list[ItemFileLineData]]) -> int:
+    return sum(process_utterances(groups, _worker_ctx, _worker_io_threads))
+
+def process_item_file_data(item_file_data: list[ItemFileLineData],
+                           ctx: ExtractionContext,
+                           jobs: int,
+                           io_threads: int):
+    import tqdm
+    create_output_dirs(item_file_data, ctx)
+    groups = group_by_file(item_file_data)
+    with tqdm.tqdm(total=len(item_file_data), mininterval=60, maxinterval=70) as pbar:
+        if jobs <= 1:
+            for n_done in process_utterances(groups, ctx, io_threads):
+                pbar.update(n_done)
+            return
+        tasks = [groups[i:i + WORKER_TASK_SIZE] for i in range(0, len(groups), WORKER_TASK_SIZE)]
+        with Pool(jobs, initializer=_init_worker, initargs=(ctx, io_threads)) as pool:
+            for n_done in pool.imap_unordered(_process_utterances, tasks):
+                pbar.update(n_done)
+
+def verify_item_file_data(item_file_data: list[ItemFileLineData],
+                          ctx: ExtractionContext) -> VerificationResult:
+    """Check that every word of the submission has exactly one output file,
+    whatever the shards that were run, and that there is nothing else."""
+    expected = {word_file_output(ifld, [], ctx).absolute_file_path
+                for ifld in item_file_data if ifld.file_name in ctx.file_loc_dict}
+    found: set[str] = set()
+    for d in {os.path.dirname(p) for p in expected}:
+        if os.path.isdir(d):
+            found.update(os.path.join(d, f) for f in os.listdir(d))
+    return VerificationResult(len(expected), sorted(expected - found), sorted(found - expected))
+
+def save_word_indices(item_file_data: list[ItemFileLineData],
+                       args: ExtractorArgs,
+                       phonetic_data_path: str,
+                       file_loc_dict: dict[str, str]):
+    """Instead of copying the frames of each word, write one word index per
+    subset dir with the frame range of each word in the submission files."""
+    rows_by_subdir: dict[str, list[WordIndexRow]] = {}
+    for ifld in item_file_data:
+        # NB! Not all lines are in the submission sets!
+        if not ifld.file_name in file_loc_dict:
+            continue
+        subdir = file_loc_dict[ifld.file_name]
+        rows_by_subdir.setdefault(subdir, []).append(
+            WordIndexRow(ifld.file_name, ifld.f_start, ifld.f_end, ifld.gold_label))
+    submissiondirname = os.path.basename(os.path.normpath(args.submission_path))
+    for subdir, rows in rows_by_subdir.items():
+        out_dir = os.path.join(args.output_path, submissiondirname, 'phonetic', subdir)
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        data_dir_path = os.path.abspath(os.path.join(phonetic_data_path, subdir))
+        write_word_index(os.path.join(out_dir, WORD_INDEX_F_NAME), WordIndex(data_dir_path, rows))
 
 def save_file_representations(file_output: FileOutput):
-        d = os.path.dirname(file_output.absolute_file_path)
-        Path(d).mkdir(parents=True, exist_ok=True)
         with open(file_output.absolute_file_path, 'a') as f:
             for frame in file_output.representations:
                 f.write(frame)
@@ -122,14 +243,8 @@ def file_loc_dict(phonetic_data_path: str):
             loc_d[file_name.strip('.txt')] = subdir
     return loc_d
 
-def n_frames_to_skip(seconds_to_skip: float, frame_step: float):
-    return int(seconds_to_skip / frame_step) # frame_step aka ~ feature size
-
-def n_frames_to_include(start: float, end: float, frame_step: float):
-    duration = end - start # in s
-    return int(duration / frame_step)
-
 def get_submission_params(yaml_file: TextIOWrapper, submissiondirname: str):
+    import yaml
     try:
         with yaml_file:
             meta = yaml.safe_load(yaml_file.read())
@@ -142,7 +257,12 @@ def get_submission_params(yaml_file: TextIOWrapper, submissiondirname: str):
 
 
 def process_submission(args: ExtractorArgs,
-                       gold_location_d: dict[str, str]):
+                       gold_location_d: dict[str, str],
+                       item_index: ItemIndex | None = None,
+                       verify: bool = False) -> VerificationResult | None:
+    """item_index: compiled item file, to share it between submissions.
+    Loaded from args.item_file_path (or its cache) if not given.
+    verify: only check the output of a previous extraction, see verify_item_file_data."""
     submissiondirname = os.path.basename(os.path.normpath(args.submission_path))
     yaml_response = metayaml_file(args.submission_path)
     if not yaml_response:
@@ -153,19 +273,32 @@ def process_submission(args: ExtractorArgs,
     if not os.path.isdir(phonetic_data_path):
         raise IOError(f"Not a dir: {phonetic_data_path}.")
 
-    item_file_lines = get_item_file_lines(args.item_file_path)
-    if not item_file_lines:
+    if item_index is None:
+        item_index = load_item_index(args.item_file_path)
+    if item_index is None:
         raise ValueError(f"Failed to retrieve item file lines at {args.item_file_path}.")
+    # This is also where we are going get the name for our feature file: '{file_name}_{start}_{end}_{gold_label}...'
+    item_file_data = get_item_file_data(item_index, submission_params.frame_shift)
     loc_d = file_loc_dict(phonetic_data_path)
     if not loc_d:
         raise ValueError("Failed to construct a location dictionary for the submission files.")
     if not loc_d == gold_location_d:
         print("WARNING! Check submission integrity, location dictionary does not match gold. Continuing extraction ...")
-    for line in tqdm.tqdm(item_file_lines, mininterval=60, maxinterval=70):
-        # This is also where we are going get the name for our feature file: '{file_name}_{start}_{end}_{gold_label}...'
-        file_name, start, end, gold_label = line.split()
-        item_file_line_data = ItemFileLineData(file_name, float(start), float(end), gold_label)
-        process_item_file_line(item_file_line_data, args, phonetic_data_path, loc_d, submission_params.frame_shift)
+    ctx = ExtractionContext(phonetic_data_path,
+                            os.path.join(args.output_path, submissiondirname, 'phonetic'),
+                            loc_d,
+                            submission_params.frame_shift)
+    if verify:
+        return verify_item_file_data(item_file_data, ctx)
+    # Keep the submission parameters (e.g. the metric) with the features for compute_map_from_dir
+    Path(os.path.join(args.output_path, submissiondirname)).mkdir(parents=True, exist_ok=True)
+    shutil.copy(yaml_file.name, os.path.join(args.output_path, submissiondirname, 'meta.yaml'))
+    if args.index_only:
+        save_word_indices(item_file_data, args, phonetic_data_path, loc_d)
+        print('... DONE.')
+        return
+    item_file_data = [ifld for ifld in item_file_data if in_shard(ifld.file_name, args.shard)]
+    process_item_file_data(item_file_data, ctx, args.jobs, args.io_threads)
     print('... DONE.')
 
 def add_parser_single_job_args(parser: argparse.ArgumentParser):
@@ -187,18 +320,72 @@ def add_parser_single_job_args(parser: argparse.ArgumentParser):
         help="Path to the item file containing word level splits, no hapax." # words_split_nohapax
     )
 
+    parser.add_argument(
+        "--index_only",
+        action="store_true",
+        help=("Do not copy the frames of each word. Only write, for each subset, an index of"
+              " (file, start frame, end frame, label) pointing into the submission files,"
+              f" saved as {WORD_INDEX_F_NAME}. compute_map_from_dir.py reads the frames from the"
+              " submission directly, so the submission must stay in place.")
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=("Number of worker processes. The item file lines are sharded by utterance"
+              " across the workers; the output is the same as with a single process.")
+    )
+
+    parser.add_argument(
+        "--io_threads",
+        type=int,
+        default=0,
+        help=("Number of reader threads (and of writer threads), per process, prefetching"
+              " submission files and writing word files while the words are extracted."
+              " 0 runs everything sequentially.")
+    )
+
+    add_parser_shard_args(parser, ("Only extract the words of the utterances of shard i of N, assigned"
+                                   " by a stable hash of the utterance name, so that N independent jobs"
+                                   " together extract the whole submission."))
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help=("Do not extract anything. Check that the output has exactly one file for every"
+              " word of the submission in the item file (e.g. after running all the shards).")
+    )
+
 def main(argv):
     description = ("Extract features from a submission and save them word by word. This is used for the map calculation.")
     parser = argparse.ArgumentParser(description=description)
     add_parser_single_job_args(parser)
     cmdlineargs = parser.parse_args(argv)
+    if cmdlineargs.index_only and (cmdlineargs.verify or cmdlineargs.shard.count > 1):
+        parser.error("--index_only takes seconds and writes a single index per subset, it does not support --shard or --verify.")
     args = ExtractorArgs(cmdlineargs.submission_path,
                          cmdlineargs.output_path,
-                         cmdlineargs.item_file_path)
+                         cmdlineargs.item_file_path,
+                         cmdlineargs.index_only,
+                         cmdlineargs.jobs,
+                         cmdlineargs.io_threads,
+                         cmdlineargs.shard)
     print(f'... Feature extraction ... Args:\n {args}')
     with open(GOLD_LOC_DIC, "r") as f:
         gold_loc_d = json.load(f)
-    process_submission(args, gold_loc_d)
+    if not cmdlineargs.verify:
+        process_submission(args, gold_loc_d)
+        return
+    result = process_submission(args, gold_loc_d, verify=True)
+    for p in result.missing:
+        print(f'Missing: {p}')
+    for p in result.unexpected:
+        print(f'Unexpected: {p}')
+    print(f'{result.n_expected - len(result.missing)}/{result.n_expected} expected files found,'
+          f' {len(result.unexpected)} unexpected.')
+    if result.missing or result.unexpected:
+        sys.exit(1)
 
 if __name__ == "__main__":
     args = sys.argv[1:]
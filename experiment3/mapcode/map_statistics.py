@@ -0,0 +1,78 @@
+import numpy as np
+
+# Everything here is derived from the per-query average precisions of a
+# single kNN pass (see knn_search.average_precisions), no kNN is rerun.
+QUERY = 'query'  # bootstrap unit: resample word tokens
+WORD = 'word'  # bootstrap unit: resample word types, with all their tokens
+BOOTSTRAP_UNITS = (QUERY, WORD)
+BOOTSTRAP_CHUNK = 100  # resamples drawn at once, to cap memory
+
+
+def bootstrap_maps(aps, labels, n_resamples, unit=QUERY, seed=0):
+    '''MAP of n_resamples bootstrap resamples of the queries.
+
+    Parameters:
+        - aps (1D numpy array): average precision of each query
+        - labels (1D numpy array): integer label of each query
+        - unit (str): QUERY resamples the queries themselves, WORD resamples
+                      the word types, so that frequent words with correlated
+                      errors do not make the interval look narrower than it is.
+    Returns:
+        - maps (1D numpy array): shape = (n_resamples,), empty if there are no queries
+    '''
+    rng = np.random.default_rng(seed)
+    if len(aps) == 0:
+        return np.empty(0)
+    maps = np.empty(n_resamples)
+    if unit == QUERY:
+        n = len(aps)
+        for b in range(0, n_resamples, BOOTSTRAP_CHUNK):
+            n_chunk = min(BOOTSTRAP_CHUNK, n_resamples - b)
+            maps[b:b + n_chunk] = aps[rng.integers(0, n, (n_chunk, n))].mean(axis=1)
+        return maps
+    if unit != WORD:
+        raise ValueError(f'Unsupported bootstrap unit {unit}, choose from {BOOTSTRAP_UNITS}.')
+    types, type_ids = np.unique(labels, return_inverse=True)
+    ap_sums = np.bincount(type_ids, weights=aps)
+    counts = np.bincount(type_ids)
+    n_types = len(types)
+    for b in range(0, n_resamples, BOOTSTRAP_CHUNK):
+        n_chunk = min(BOOTSTRAP_CHUNK, n_resamples - b)
+        # how many times each type is drawn in each resample
+        rows = np.repeat(np.arange(n_chunk), n_types)
+        drawn = rows * n_types + rng.integers(0, n_types, n_chunk * n_types)
+        draws = np.bincount(drawn, minlength=n_chunk * n_types).reshape(n_chunk, n_types)
+        maps[b:b + n_chunk] = (draws @ ap_sums) / (draws @ counts)
+    return maps
+
+
+def confidence_interval(maps, confidence=0.95):
+    '''Percentile interval of the bootstrap MAPs, None without resamples.'''
+    if len(maps) == 0:
+        return None
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(maps, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def per_label_map(aps, labels):
+    '''Returns: {label: (MAP over its tokens, number of tokens)}.'''
+    types, type_ids = np.unique(labels, return_inverse=True)
+    ap_sums = np.bincount(type_ids, weights=aps)
+    counts = np.bincount(type_ids)
+    return {int(t): (float(s / c), int(c)) for t, s, c in zip(types, ap_sums, counts)}
+
+
+def map_by_frequency(aps, labels):
+    '''MAP of the tokens grouped by the frequency of their word, in buckets
+    of powers of 2 (2-3 tokens, 4-7 tokens, ...).
+    Returns: {bucket name: (MAP, number of tokens, number of word types)}.'''
+    _, type_ids, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    type_buckets = np.floor(np.log2(counts)).astype(int)
+    token_buckets = type_buckets[type_ids]
+    out = {}
+    for b in np.unique(type_buckets):
+        in_bucket = token_buckets == b
+        name = f'{2 ** b}-{2 ** (b + 1) - 1}'
+        out[name] = (float(aps[in_bucket].mean()), int(in_bucket.sum()), int(np.sum(type_buckets == b)))
+    return out
@@ -0,0 +1,38 @@
+import argparse
+import zlib
+from typing import NamedTuple
+
+# Work is assigned to shards by a stable hash of the utterance id, so that N
+# independent jobs (e.g. a cluster array job) split a submission without
+# coordination and agree on who does what. The key is always the bare
+# utterance id, e.g. 1272-128104-0000 (no extension, no word suffix), so that
+# shard i/N is the same set of utterances for every script: the generators of
+# experiment2, convolution_submission_gen.py, map_feature_extractor.py and
+# compute_map_from_dir.py all import this module.
+
+class Shard(NamedTuple):
+    index: int # 0 <= index < count
+    count: int
+
+NO_SHARDING = Shard(0, 1)
+
+def parse_shard(spec: str) -> Shard:
+    '''Parses 'i/N' (0 <= i < N) as used on the command line.'''
+    try:
+        index, count = (int(x) for x in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{spec}: a shard should be given as i/N, with 0 <= i < N.')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'{spec}: a shard should be given as i/N, with 0 <= i < N.')
+    return Shard(index, count)
+
+def in_shard(utterance_id: str, shard: Shard) -> bool:
+    return zlib.crc32(utterance_id.encode()) % shard.count == shard.index
+
+def add_parser_shard_args(parser: argparse.ArgumentParser, help: str):
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=NO_SHARDING,
+        help=f"Given as i/N (0 <= i < N). {help}"
+    )
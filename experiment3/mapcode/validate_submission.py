@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter
+from multiprocessing import Pool
+from typing import NamedTuple
+
+import numpy as np
+
+from item_index import load_item_index
+from map_feature_extractor import (GOLD_LOC_DIC, PHONETIC_SUB_DIRS, get_submission_params,
+                                   metayaml_file)
+
+# Checks a submission up front, in seconds to minutes, instead of finding the
+# problems one by one during the feature extraction and the MAP computation.
+# Each file is read once as bytes: the frames and values are counted and
+# non-finite values searched for without parsing the floats, only a few
+# sampled lines are parsed.
+SAMPLE_LINES = 8  # lines parsed at the start and at the end of each file
+WORKER_TASK_SIZE = 64  # files per task sent to a --jobs worker
+MAX_LISTED = 10  # problems printed per kind, the others are only counted
+NON_FINITE = re.compile(rb'nan|inf', re.IGNORECASE)
+
+# Kinds of problems
+LAYOUT = 'layout'  # missing subset, stray dir or file
+MISSING = 'missing'  # file of gold_loc_d.json not in the submission
+UNEXPECTED = 'unexpected'  # file not in gold_loc_d.json
+WRONG_SUBSET = 'wrong subset'
+UNREADABLE = 'unreadable'
+EMPTY = 'empty'
+UNPARSABLE = 'unparsable'  # sampled lines are not all numbers
+DIMENSION = 'dimension'  # frames of different sizes, within or across files
+NOT_FINITE = 'not finite'
+SHORT = 'short'  # fewer frames than the item file segments of the utterance
+
+
+class FileCheck(NamedTuple):
+    file_name: str  # utterance
+    path: str
+    n_frames: int
+    dims: int  # of the frames, -1 if they differ
+    readable: bool
+    parsable: bool
+    finite: bool
+
+
+class ValidationReport(NamedTuple):
+    n_files: int
+    problems: dict[str, list[str]]  # kind -> descriptions
+
+    def ok(self) -> bool:
+        return not any(self.problems.values())
+
+
+def list_submission_files(phonetic_data_path: str, problems: dict[str, list[str]]) -> dict[str, str]:
+    '''Same as map_feature_extractor.file_loc_dict, but carries on past the
+    problems, reporting them all.
+    Returns: {file name: subdir}'''
+    loc_d: dict[str, str] = {}
+    for subdir in PHONETIC_SUB_DIRS:
+        subdir_path = os.path.join(phonetic_data_path, subdir)
+        if not os.path.isdir(subdir_path):
+            problems[LAYOUT].append(f'Unable to find {subdir} in submission.')
+            continue
+        for entry in os.scandir(subdir_path):
+            if not entry.is_file():
+                problems[LAYOUT].append(f'Found a dir at {entry.path}, should only include files.')
+            elif not entry.name.lower().endswith('.txt'):
+                problems[LAYOUT].append(f'Unexpected extension for {entry.path}.')
+            else:
+                loc_d[entry.name[:-len('.txt')]] = subdir
+    return loc_d
+
+
+def compare_with_gold(loc_d: dict[str, str], gold_loc_d: dict[str, str], problems: dict[str, list[str]]):
+    for file_name in sorted(gold_loc_d.keys() - loc_d.keys()):
+        problems[MISSING].append(f'{gold_loc_d[file_name]}/{file_name}.txt')
+    for file_name in sorted(loc_d.keys() - gold_loc_d.keys()):
+        problems[UNEXPECTED].append(f'{loc_d[file_name]}/{file_name}.txt')
+    for file_name in sorted(loc_d.keys() & gold_loc_d.keys()):
+        if loc_d[file_name] != gold_loc_d[file_name]:
+            problems[WRONG_SUBSET].append(f'{loc_d[file_name]}/{file_name}.txt should be in {gold_loc_d[file_name]}')
+
+
+def check_file(task: tuple[str, str]) -> FileCheck:
+    file_name, path = task
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return FileCheck(file_name, path, 0, 0, False, False, False)
+    n_frames = data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+    lines = data.split(b'\n', SAMPLE_LINES)[:SAMPLE_LINES] + data.rsplit(b'\n', SAMPLE_LINES + 1)[1:]
+    try:
+        sizes = {len(np.array(l.split(), dtype=np.float64)) for l in lines if l.strip()}
+    except ValueError:
+        return FileCheck(file_name, path, n_frames, 0, True, False, NON_FINITE.search(data) is None)
+    dims = sizes.pop() if len(sizes) == 1 else (0 if not sizes else -1)
+    # every frame, not only the sampled ones, must have dims values
+    if dims > 0 and len(data.split()) != n_frames * dims:
+        dims = -1
+    return FileCheck(file_name, path, n_frames, dims, True, True, NON_FINITE.search(data) is None)
+
+
+def check_files(tasks: list[tuple[str, str]], jobs: int) -> list[FileCheck]:
+    if jobs <= 1:
+        return [check_file(task) for task in tasks]
+    with Pool(jobs) as pool:
+        return list(pool.imap_unordered(check_file, tasks, chunksize=WORKER_TASK_SIZE))
+
+
+def required_frames(item_file_path: str, frame_step: float) -> dict[str, int]:
+    '''Number of frames each utterance needs for all its item file segments,
+    with the frame ranges used by map_feature_extractor.'''
+    item_index = load_item_index(item_file_path)
+    if item_index is None:
+        raise ValueError(f"Failed to retrieve item file lines at {item_file_path}.")
+    _, f_ends = item_index.frame_ranges(frame_step)
+    required: dict[str, int] = {}
+    for file_name, f_end in zip(item_index.file_names.tolist(), f_ends.tolist()):
+        required[file_name] = max(required.get(file_name, 0), f_end)
+    return required
+
+
+def file_problems(checks: list[FileCheck], required: dict[str, int], problems: dict[str, list[str]]):
+    dims = Counter(c.dims for c in checks if c.dims > 0)
+    expected_dims = dims.most_common(1)[0][0] if dims else 0
+    for c in sorted(checks):
+        if not c.readable:
+            problems[UNREADABLE].append(c.path)
+            continue
+        if c.n_frames == 0:
+            problems[EMPTY].append(c.path)
+            continue
+        if not c.parsable:
+            problems[UNPARSABLE].append(c.path)
+        elif c.dims == -1:
+            problems[DIMENSION].append(f'{c.path}: frames of different sizes')
+        elif c.dims != expected_dims:
+            problems[DIMENSION].append(f'{c.path}: {c.dims} dimensions, {expected_dims} in most files')
+        if not c.finite:
+            problems[NOT_FINITE].append(c.path)
+        if c.n_frames < required.get(c.file_name, 0):
+            problems[SHORT].append(f'{c.path}: {c.n_frames} frames, the item file needs {required[c.file_name]}')
+
+
+def validate_submission(submission_path: str,
+                        gold_loc_d: dict[str, str],
+                        item_file_path: str | None = None,
+                        jobs: int = 1) -> ValidationReport:
+    problems: dict[str, list[str]] = {kind: [] for kind in (LAYOUT, MISSING, UNEXPECTED, WRONG_SUBSET,
+                                                            UNREADABLE, EMPTY, UNPARSABLE, DIMENSION,
+                                                            NOT_FINITE, SHORT)}
+    submissiondirname = os.path.basename(os.path.normpath(submission_path))
+    yaml_response = metayaml_file(submission_path)
+    if not yaml_response:
+        problems[LAYOUT].append(f"No yaml file for {submissiondirname}.")
+        return ValidationReport(0, problems)
+    try:
+        submission_params = get_submission_params(yaml_response.yaml_file, submissiondirname)
+    except IOError as e:
+        problems[LAYOUT].append(str(e))
+        return ValidationReport(0, problems)
+    phonetic_data_path = os.path.join(yaml_response.submission_data_path, 'phonetic')
+    if not os.path.isdir(phonetic_data_path):
+        problems[LAYOUT].append(f"Not a dir: {phonetic_data_path}.")
+        return ValidationReport(0, problems)
+
+    loc_d = list_submission_files(phonetic_data_path, problems)
+    compare_with_gold(loc_d, gold_loc_d, problems)
+    required = {} if item_file_path is None else required_frames(item_file_path, submission_params.frame_shift)
+    tasks = [(file_name, os.path.join(phonetic_data_path, subdir, file_name + '.txt'))
+             for file_name, subdir in loc_d.items()]
+    file_problems(check_files(tasks, jobs), required, problems)
+    return ValidationReport(len(tasks), problems)
+
+
+def print_report(report: ValidationReport):
+    for kind, descriptions in report.problems.items():
+        for d in descriptions[:MAX_LISTED]:
+            print(f'{kind}: {d}')
+        if len(descriptions) > MAX_LISTED:
+            print(f'{kind}: ... and {len(descriptions) - MAX_LISTED} more')
+    summary = ', '.join(f'{len(d)} {kind}' for kind, d in report.problems.items() if d)
+    print(f'{report.n_files} files checked. ' + (f'FAILED: {summary}.' if summary else 'OK.'))
+
+
+def main(argv):
+    description = ("Check that a submission is complete and well formed before extracting its features:"
+                   f" files of {GOLD_LOC_DIC}, frame dimensions, NaN/Inf values and, with the item file,"
+                   " enough frames for every word. Exits with status 1 if anything is wrong.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "submission_path",
+        type=str,
+        help="Path to the directory of the submission (with its meta.yaml)."
+    )
+    parser.add_argument(
+        "--item_file_path",
+        type=str,
+        default=None,
+        help="Item file whose segments must be covered by the frames of each file."
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes checking files."
+    )
+    cmdlineargs = parser.parse_args(argv)
+    with open(GOLD_LOC_DIC, "r") as f:
+        gold_loc_d = json.load(f)
+    report = validate_submission(cmdlineargs.submission_path,
+                                 gold_loc_d,
+                                 cmdlineargs.item_file_path,
+                                 cmdlineargs.jobs)
+    print_report(report)
+    if not report.ok():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
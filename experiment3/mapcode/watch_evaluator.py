@@ -0,0 +1,355 @@
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+from typing import NamedTuple
+
+# The convolution generator lives next to mapcode and imports its own modules by name
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'convolution_submission_gen'))
+
+import convolution_submission_gen as conv_gen
+import compute_map_from_dir
+from map_feature_extractor import GOLD_LOC_DIC, ExtractorArgs, metayaml_file, process_submission
+
+# Watches a directory where submissions (one dir per submission, with its
+# meta.yaml) are dropped, and evaluates each of them for every variant (the
+# original or a convolution of it): convolution_submission_gen.py, then
+# map_feature_extractor.py --index_only, then compute_map_from_dir.py.
+# A (submission, variant) is evaluated again only when the files of the
+# submission change, as seen by their fingerprint. Everything runs in a pool of
+# long-lived worker processes, which keep the compiled item file and the imports.
+ORIGINAL = 'original'
+STATE_F_NAME = 'watch_state.json'
+RESULTS_F_NAME = 'results.tsv'
+MAP_SUB_DIR = 'phonetic/dev-clean'  # the subset evaluated by compute_map_from_dir.py
+RESULT_COLUMNS = ('submission', 'variant', 'status', 'metric', 'MAP_meanpooling', 'MAP_maxpooling',
+                  'fingerprint', 'updated', 'error')
+DONE = 'done'
+FAILED = 'failed'
+
+class Variant(NamedTuple):
+    convolution_type: str | None  # None for the original submission
+    window_s_running_mean: int = 3  # also the window of the gaussians
+    max_sharpen: bool = False
+    window_s_laplacian: int = conv_gen.LAPLACIAN_WS
+    sigma: float = 0.0
+    sigma_ratio: float = conv_gen.GAUSSIAN_SIGMA_RATIO
+    kernel_taps: tuple[float, ...] = ()
+
+    def name(self) -> str:
+        '''Also the dir of the variant, e.g. running_mean/av_ws_5.'''
+        if self.convolution_type is None:
+            return ORIGINAL
+        return f'{self.convolution_type}/{conv_gen.ConvolutionSubmissionGenerator().window_s_name(self.generator_args("", ""))}'
+
+    def generator_args(self, submission_path: str, output_path: str):
+        return conv_gen.GeneratorArgs(submission_path,
+                                      output_path,
+                                      self.convolution_type,
+                                      self.window_s_running_mean,
+                                      self.max_sharpen,
+                                      copy_meta=True,
+                                      batch_size=16,
+                                      window_s_laplacian=self.window_s_laplacian,
+                                      sigma=self.sigma,
+                                      sigma_ratio=self.sigma_ratio,
+                                      kernel_taps=self.kernel_taps)
+
+# Options of each convolution type in a --variants spec, see parse_variant
+WINDOW = 'window'  # a bare integer: the window of the kernel
+VARIANT_OPTIONS = {
+    conv_gen.RUNNING_MEAN: {WINDOW},
+    conv_gen.LAPLACIAN: {WINDOW, 'max_sharpen'},
+    conv_gen.BLUR_THEN_SHARPEN: {WINDOW, 'lapl', 'max_sharpen'},
+    conv_gen.GAUSSIAN: {WINDOW, 'sigma'},
+    conv_gen.DIFFERENCE_OF_GAUSSIANS: {WINDOW, 'sigma', 'ratio'},
+    conv_gen.CUSTOM: {'taps'},
+}
+
+class EvaluationJob(NamedTuple):
+    submission_name: str
+    submission_path: str
+    variant: Variant
+    fingerprint: str
+    work_path: str
+    item_file_path: str
+    map_args: list[str]  # extra compute_map_from_dir.py options
+
+def parse_variant(spec: str) -> Variant:
+    '''original, or convolution_type[:option]..., with the options of
+    VARIANT_OPTIONS: the window size (of the laplacian for laplacian, of the
+    running mean or the gaussians otherwise), lapl=N (laplacian window of
+    blur_then_sharpen), max_sharpen, sigma=X, ratio=X and taps=X,Y,Z (custom),
+    e.g. running_mean:5, laplacian:5:max_sharpen, blur_then_sharpen:7:lapl=5,
+    gaussian:25:sigma=3, difference_of_gaussians:31:ratio=2, custom:taps=0.25,0.5,0.25.'''
+    if spec == ORIGINAL:
+        return Variant(None)
+    convolution_type, *options = spec.split(':')
+    if convolution_type not in VARIANT_OPTIONS:
+        raise argparse.ArgumentTypeError(f'{spec}: unsupported convolution type.')
+    variant = Variant(convolution_type)
+    for option in options:
+        key, _, value = option.partition('=')
+        if option.isdigit():
+            key = WINDOW
+        if key not in VARIANT_OPTIONS[convolution_type]:
+            raise argparse.ArgumentTypeError(f'{spec}: option {option} not supported by {convolution_type}.')
+        try:
+            if key == WINDOW and convolution_type == conv_gen.LAPLACIAN:
+                variant = variant._replace(window_s_laplacian=int(option))
+            elif key == WINDOW:
+                variant = variant._replace(window_s_running_mean=int(option))
+            elif key == 'lapl':
+                variant = variant._replace(window_s_laplacian=int(value))
+            elif key == 'max_sharpen' and not value:
+                variant = variant._replace(max_sharpen=True)
+            elif key == 'sigma':
+                variant = variant._replace(sigma=float(value))
+            elif key == 'ratio':
+                variant = variant._replace(sigma_ratio=float(value))
+            elif key == 'taps':
+                variant = variant._replace(kernel_taps=tuple(float(t) for t in value.split(',')))
+            else:
+                raise ValueError
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'{spec}: invalid option {option}.')
+    if convolution_type == conv_gen.CUSTOM and not variant.kernel_taps:
+        raise argparse.ArgumentTypeError(f'{spec}: the custom convolution needs taps=X,Y,Z.')
+    # e.g. an even window, now rather than in every job
+    try:
+        conv_gen.kernel_type(convolution_type).kernels(variant.generator_args('', ''))
+    except (ValueError, NotImplementedError) as e:
+        raise argparse.ArgumentTypeError(f'{spec}: {e}')
+    return variant
+
+def find_submissions(watch_path: str) -> dict[str, str]:
+    '''{name: path} of the dirs of watch_path with a meta.yaml.'''
+    submissions = {}
+    for entry in sorted(os.scandir(watch_path), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        yaml_response = metayaml_file(entry.path)
+        if yaml_response:
+            yaml_response.yaml_file.close()
+            submissions[entry.name] = entry.path
+    return submissions
+
+def fingerprint(submission_path: str) -> str:
+    '''Hash of the path, size and modification time of every file of the
+    submission: cheap to compute every poll, and changes with any new,
+    removed or rewritten file.'''
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(submission_path):
+        dirs.sort()
+        for f in sorted(files):
+            stat = os.stat(os.path.join(root, f))
+            rel_path = os.path.relpath(os.path.join(root, f), submission_path)
+            h.update(f'{rel_path}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+def fresh_dir(path: str) -> str:
+    # the generator and the extractor append to existing files
+    shutil.rmtree(path, ignore_errors=True)
+    return path
+
+def evaluate(job: EvaluationJob) -> dict:
+    '''Convolution (unless original), word index and MAP of one submission
+    variant, in a worker. Returns: the state entry of the job.'''
+    entry = {'fingerprint': job.fingerprint, 'updated': datetime.now().isoformat(timespec='seconds')}
+    variant_name = job.variant.name()
+    try:
+        submission_path = job.submission_path
+        if job.variant.convolution_type is not None:
+            convolved_path = os.path.join(job.work_path, 'convolved')
+            submission_path = os.path.join(convolved_path, variant_name, job.submission_name)
+            fresh_dir(submission_path)
+            conv_gen.ConvolutionSubmissionGenerator().generate_submission(
+                job.variant.generator_args(job.submission_path, convolved_path))
+        features_path = os.path.join(job.work_path, 'features', variant_name)
+        fresh_dir(os.path.join(features_path, job.submission_name))
+        process_submission(ExtractorArgs(submission_path, features_path, job.item_file_path, index_only=True),
+                           _gold_loc_d)
+        map_path = os.path.join(job.work_path, 'map', variant_name)
+        compute_map_from_dir.main([os.path.join(features_path, job.submission_name), map_path, *job.map_args])
+        with open(os.path.join(map_path, job.submission_name, MAP_SUB_DIR, 'map_results.json')) as f:
+            map_results = json.load(f)
+    except (Exception, SystemExit) as e:
+        entry.update(status=FAILED, error=f'{type(e).__name__}: {e}')
+        return entry
+    entry.update(status=DONE,
+                 metric=map_results['metric'],
+                 MAP_meanpooling=map_results['MAP_meanpooling'],
+                 MAP_maxpooling=map_results['MAP_maxpooling'])
+    return entry
+
+# Loaded once per worker, through the initializer
+_gold_loc_d: dict[str, str] = {}
+
+def _init_worker(gold_loc_d: dict[str, str]):
+    global _gold_loc_d
+    _gold_loc_d = gold_loc_d
+
+def load_state(work_path: str) -> dict[str, dict[str, dict]]:
+    '''{submission: {variant: entry}}, see evaluate.'''
+    state_path = os.path.join(work_path, STATE_F_NAME)
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+def save_state(state: dict[str, dict[str, dict]], work_path: str):
+    '''The state, and the results table made from it. Written to temporary
+    files first, so that a reader never sees half a file.'''
+    state_path = os.path.join(work_path, STATE_F_NAME)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+    results_path = os.path.join(work_path, RESULTS_F_NAME)
+    with open(results_path + '.tmp', 'w') as f:
+        f.write('\t'.join(RESULT_COLUMNS) + '\n')
+        for submission_name in sorted(state):
+            for variant_name, entry in sorted(state[submission_name].items()):
+                row = {'submission': submission_name, 'variant': variant_name, **entry}
+                f.write('\t'.join(str(row.get(c, '')) for c in RESULT_COLUMNS) + '\n')
+    os.replace(results_path + '.tmp', results_path)
+
+class WatchArgs(NamedTuple):
+    watch_path: str
+    work_path: str
+    item_file_path: str
+    variants: list[Variant]
+    jobs: int = 1
+    poll_s: float = 60
+    once: bool = False  # evaluate what is there, wait for it and stop
+    map_args: list[str] = []
+
+def pending_jobs(args: WatchArgs,
+                 state: dict[str, dict[str, dict]],
+                 previous_fingerprints: dict[str, str],
+                 fingerprints: dict[str, str],
+                 submissions: dict[str, str],
+                 running: set[tuple[str, str]]) -> list[EvaluationJob]:
+    '''Jobs of the (submission, variant) pairs not evaluated on the current
+    files of the submission. Unless args.once, a submission is only taken once
+    its fingerprint did not change between two polls, i.e. once it is fully copied.'''
+    jobs = []
+    for name, path in submissions.items():
+        if not args.once and previous_fingerprints.get(name) != fingerprints[name]:
+            continue
+        for variant in args.variants:
+            entry = state.get(name, {}).get(variant.name())
+            if (name, variant.name()) in running or (entry and entry['fingerprint'] == fingerprints[name]):
+                continue
+            jobs.append(EvaluationJob(name, path, variant, fingerprints[name],
+                                      args.work_path, args.item_file_path, args.map_args))
+    return jobs
+
+def watch(args: WatchArgs, gold_loc_d: dict[str, str]):
+    os.makedirs(args.work_path, exist_ok=True)
+    state = load_state(args.work_path)
+    fingerprints: dict[str, str] = {}
+    running = {}  # (submission, variant name) -> AsyncResult
+    last_poll = None
+    with Pool(args.jobs, initializer=_init_worker, initargs=(gold_loc_d,)) as pool:
+        while True:
+            for key, result in list(running.items()):
+                if not result.ready():
+                    continue
+                del running[key]
+                entry = result.get()
+                state.setdefault(key[0], {})[key[1]] = entry
+                save_state(state, args.work_path)
+                print(f'{key[0]} {key[1]}: {entry["status"]}'
+                      + (f', MAP {entry["MAP_meanpooling"]:.3f} (mean) {entry["MAP_maxpooling"]:.3f} (max)'
+                         if entry['status'] == DONE else f', {entry["error"]}'))
+            if args.once and last_poll is not None:
+                if not running:
+                    return
+            elif last_poll is None or time.monotonic() - last_poll >= args.poll_s:
+                last_poll = time.monotonic()
+                submissions = find_submissions(args.watch_path)
+                previous_fingerprints = fingerprints
+                fingerprints = {name: fingerprint(path) for name, path in submissions.items()}
+                for job in pending_jobs(args, state, previous_fingerprints, fingerprints,
+                                        submissions, set(running)):
+                    print(f'Scheduling {job.submission_name} {job.variant.name()}')
+                    running[(job.submission_name, job.variant.name())] = pool.apply_async(evaluate, (job,))
+            time.sleep(1)
+
+def main(argv):
+    description = ("Watch a directory of submissions and evaluate the MAP of every new or changed"
+                   " submission, for each variant (the original and convolutions of it). Results are"
+                   f" kept in {RESULTS_F_NAME} in work_path.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "watch_path",
+        type=str,
+        help="Directory where the submissions are dropped, one dir (with its meta.yaml) per submission."
+    )
+    parser.add_argument(
+        "work_path",
+        type=str,
+        help=("Where the convolved submissions, word indices, MAP results, the state of the"
+              f" evaluator ({STATE_F_NAME}) and the results table are written.")
+    )
+    parser.add_argument(
+        "item_file_path",
+        type=str,
+        help="Path to the item file containing word level splits, no hapax."
+    )
+    parser.add_argument(
+        "--variants",
+        type=parse_variant,
+        nargs="+",
+        default=[Variant(None)],
+        help=("original, or convolution_type[:option]..., e.g. running_mean:5"
+              " laplacian:5:max_sharpen blur_then_sharpen:7:lapl=5 gaussian:25:sigma=3"
+              " difference_of_gaussians:31:ratio=2 custom:taps=0.25,0.5,0.25."
+              " A bare number is the window size. See parse_variant.")
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes, each evaluating one submission variant at a time."
+    )
+    parser.add_argument(
+        "--poll_s",
+        type=float,
+        default=60,
+        help=("Seconds between two scans of watch_path. A submission is evaluated once it has not"
+              " changed for a whole poll interval.")
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Evaluate what is missing for the submissions already there, then stop."
+    )
+    parser.add_argument(
+        "--map_args",
+        type=shlex.split,
+        default=[],
+        help="Extra options for compute_map_from_dir.py, e.g. '--bootstrap 100'."
+    )
+    cmdlineargs = parser.parse_args(argv)
+    args = WatchArgs(cmdlineargs.watch_path,
+                     cmdlineargs.work_path,
+                     os.path.abspath(cmdlineargs.item_file_path),
+                     cmdlineargs.variants,
+                     cmdlineargs.jobs,
+                     cmdlineargs.poll_s,
+                     cmdlineargs.once,
+                     cmdlineargs.map_args)
+    with open(GOLD_LOC_DIC, "r") as f:
+        gold_loc_d = json.load(f)
+    watch(args, gold_loc_d)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
@@ -0,0 +1,102 @@
+import mmap
+import os
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+# A word index is a light-weight alternative to copying the frames of every
+# word into its own file: one index per subset dir, one line per word, with
+# the frame range to read from the (unmodified) submission file.
+WORD_INDEX_F_NAME = 'word_index.txt'
+PHONETIC_DATA_PATH_HEADER = '# phonetic_data_path: '
+
+
+class WordIndexRow(NamedTuple):
+    file_name: str  # without extension
+    start_frame: int
+    end_frame: int  # excluded
+    gold_label: str
+
+
+class WordIndex(NamedTuple):
+    data_dir_path: str  # dir containing the submission files of the subset
+    rows: list[WordIndexRow]
+
+
+class WordFrames(NamedTuple):
+    row: WordIndexRow
+    frames: np.ndarray  # 2D, float32
+
+
+def frame_ranges(starts: np.ndarray, ends: np.ndarray, frame_step: float):
+    """Frames of each word, for all the words at once: the word starts at
+    frame int(start / frame_step) + 1 and spans int((end - start) / frame_step)
+    frames. The only definition of this rounding, used by every extraction
+    mode and by the validator so that they all select the same frames.
+    Returns: (first frame, first frame after the word) for each word,
+    as integer arrays.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    f_start = (starts / frame_step).astype(np.int64) + 1
+    f_end = f_start + ((ends - starts) / frame_step).astype(np.int64)
+    return f_start, f_end
+
+
+def write_word_index(index_path: str, word_index: WordIndex):
+    with open(index_path, 'w') as f:
+        f.write(f'{PHONETIC_DATA_PATH_HEADER}{word_index.data_dir_path}\n')
+        for r in word_index.rows:
+            f.write(f'{r.file_name} {r.start_frame} {r.end_frame} {r.gold_label}\n')
+
+
+def read_word_index(index_path: str) -> WordIndex:
+    rows: list[WordIndexRow] = []
+    with open(index_path, 'r') as f:
+        header = f.readline()
+        if not header.startswith(PHONETIC_DATA_PATH_HEADER):
+            raise IOError(f'Missing data path header in word index {index_path}.')
+        data_dir_path = header.removeprefix(PHONETIC_DATA_PATH_HEADER).rstrip('\n')
+        for line in f:
+            file_name, start_frame, end_frame, gold_label = line.split()
+            rows.append(WordIndexRow(file_name, int(start_frame), int(end_frame), gold_label))
+    return WordIndex(data_dir_path, rows)
+
+
+def iter_word_frames(word_index: WordIndex) -> Iterator[WordFrames]:
+    """Resolve the frames of every word in the index from the submission files.
+    Each submission file is memory-mapped once and only the lines in the
+    requested frame ranges are parsed. As with list slicing in the original
+    extraction, ranges running past the end of the file are truncated and
+    empty ranges are skipped.
+    """
+    rows_by_file: dict[str, list[WordIndexRow]] = {}
+    for r in word_index.rows:
+        rows_by_file.setdefault(r.file_name, []).append(r)
+    for file_name, rows in rows_by_file.items():
+        data_file_path = os.path.join(word_index.data_dir_path, file_name + '.txt')
+        if not os.path.isfile(data_file_path):
+            raise IOError(f'No file at {data_file_path}, check submission integrity.')
+        if os.path.getsize(data_file_path) == 0:
+            continue  # mmap does not support empty files
+        with open(data_file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            line_starts, line_ends = _line_offsets(mm)
+            n_lines = len(line_starts)
+            for r in rows:
+                start, end = max(r.start_frame, 0), min(r.end_frame, n_lines)
+                if start >= end:
+                    continue
+                chunk = mm[line_starts[start]:line_ends[end - 1]]
+                frames = np.array(chunk.split(), dtype=np.float32)
+                yield WordFrames(r, frames.reshape(end - start, -1))
+
+
+def _line_offsets(mm: mmap.mmap):
+    buf = np.frombuffer(mm, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    line_ends = newlines
+    if len(buf) and buf[-1] != ord('\n'):
+        line_ends = np.append(line_ends, len(buf))  # no trailing newline
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))[:len(line_ends)]
+    return line_starts, line_ends